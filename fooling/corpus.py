@@ -5,6 +5,7 @@
 
 import sys
 import os, os.path, stat
+from hashlib import md5
 try:
   from cStringIO import StringIO
 except ImportError:
@@ -48,6 +49,12 @@ class Corpus(object):
   def close(self):
     return
 
+  # (overridable)
+  # Opens the corpus again in a child process
+  # without using the handles inherited from the parent.
+  def reopen(self):
+    return
+
   # (overridable)
   # Returns a Document object for the location.
   def get_doc(self, loc):
@@ -93,6 +100,17 @@ class Corpus(object):
   def loc_size(self, loc):
     return 0                            # zero means unknown
 
+  # Returns the MD5 digest of the contents for the location.
+  def loc_digest(self, loc):
+    h = md5()
+    fp = self.loc_fp(loc)
+    while 1:
+      data = fp.read(65536)
+      if not data: break
+      h.update(data)
+    fp.close()
+    return h.digest()
+
 
 ##  FilesystemCorpus
 ##
@@ -153,6 +171,10 @@ class BerkeleyDBCorpus(Corpus):
     from bsddb import hashopen
     self._db = hashopen(self.dbfile, mode)
     return
+
+  def reopen(self):
+    self.open()
+    return
     
   def close(self):
     self._db.close()
@@ -188,7 +210,7 @@ class CDBCorpus(Corpus):
 
   def open(self, mode='r'):
     import pycdb as cdb
-    self._db = cdb.init(self.dbfile)
+    self._db = cdb.mmapinit(self.dbfile)
     return
     
   def close(self):
@@ -236,6 +258,10 @@ class SQLiteCorpus(Corpus):
     self._cur = self._conn.cursor()
     return
 
+  def reopen(self):
+    self.open()
+    return
+
   def close(self):
     self._conn.close()
     self._conn = None
@@ -286,6 +312,11 @@ class TarDBCorpus(Corpus):
     self._db = None
     return
 
+  def reopen(self):
+    self._db = None
+    self.open()
+    return
+
   def flush(self):
     self._db.flush()
     return
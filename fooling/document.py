@@ -18,19 +18,15 @@ __all__ = [ 'Document', 'PlainTextDocument', 'SourceCodeDocument',
 
 
 def splitterms_normal(s):
-  from utils import isplit, encodew
-  for x in isplit(s):
-    yield encodew(x)
-  return
+  from utils import isplit_encoded
+  return isplit_encoded(s)
 
 def splitterms_yomi(s):
-  from utils import isplit, encodew, encodey
+  from utils import isplit_encoded, encodey
   from yomi import index_yomi
-  for x in isplit(s):
-    yield encodew(x)
-  for x in index_yomi(s):
-    yield encodey(x)
-  return
+  r = isplit_encoded(s)
+  r.extend( encodey(x) for x in index_yomi(s) )
+  return r
 
 
 ##  Document
@@ -3,16 +3,112 @@
 ##  indexdb.py
 ##
 
-import sys, os, os.path, stat, re
+import sys, os, os.path, stat, re, marshal
+from struct import pack, unpack
 import pycdb as cdb
-from utils import idx_info, idx_docid2info, idx_loc2docid
+from utils import PROP_LOC, PROP_IDXINFO
+from utils import idx_info, idx_docid2info, idx_loc2docids, idx_iterdocinfo, LRUCache
 
 
 __all__ = [
-  'IndexDB'
+  'IndexDB', 'DocBitmap', 'Manifest'
   ]
 
 
+##  DocBitmap
+##
+##  A set of docids stored as a bitmap file.
+##  Each index file "xxxNNNNN.cdb" can have "xxxNNNNN.del" that
+##  marks its deleted (or replaced) documents.
+##
+class DocBitmap(object):
+
+  def __init__(self, path):
+    self.path = path
+    try:
+      fp = file(path, 'rb')
+      self.bits = bytearray(fp.read())
+      fp.close()
+    except IOError:
+      self.bits = bytearray()
+    return
+
+  def __repr__(self):
+    return '<DocBitmap: %r, %d docs>' % (self.path, len(self))
+
+  def __len__(self):
+    return sum( bin(b).count('1') for b in self.bits )
+
+  def __contains__(self, docid):
+    i = docid >> 3
+    return i < len(self.bits) and bool(self.bits[i] & (1 << (docid & 7)))
+
+  def add(self, docid):
+    i = docid >> 3
+    if len(self.bits) <= i:
+      self.bits.extend('\x00' * (i+1-len(self.bits)))
+    self.bits[i] |= 1 << (docid & 7)
+    return
+
+  def save(self):
+    fp = file(self.path+'.tmp', 'wb')
+    fp.write(str(self.bits))
+    fp.close()
+    os.rename(self.path+'.tmp', self.path)
+    return
+
+  # Returns the bitmap filename for an index file.
+  @staticmethod
+  def get_path(idxpath):
+    return os.path.splitext(idxpath)[0]+'.del'
+
+
+##  Manifest
+##
+##  Fingerprints of the indexed documents: {loc: (mtime, size, digest)}
+##  The entries are kept in a cdb file and the changes are
+##  written all at once by save().
+##
+class Manifest(object):
+
+  def __init__(self, path):
+    self.path = path
+    self._new = {}
+    try:
+      self._cdb = cdb.init(path)
+    except IOError:
+      self._cdb = None
+    return
+
+  def __repr__(self):
+    return '<Manifest: %r>' % self.path
+
+  # Returns (mtime, size, digest) for the location, or None.
+  def get(self, loc):
+    if loc in self._new: return self._new[loc]
+    if self._cdb == None: return None
+    v = self._cdb.get(loc)
+    if v == None: return None
+    (mtime, size) = unpack('>iq', v[:12])
+    return (mtime, size, v[12:])
+
+  def set(self, loc, mtime, size, digest):
+    self._new[loc] = (mtime, size, digest)
+    return
+
+  def save(self):
+    if not self._new: return
+    maker = cdb.cdbmake(self.path, self.path+'.tmp')
+    if self._cdb != None:
+      maker.addmany( (k,v) for (k,v) in self._cdb.iteritems() if k not in self._new )
+    maker.addmany( (loc, pack('>iq', mtime, size)+digest)
+                   for (loc,(mtime,size,digest)) in sorted(self._new.iteritems()) )
+    maker.finish()
+    self._cdb = cdb.init(self.path)
+    self._new = {}
+    return
+
+
 ##  IndexDB
 ##
 class IndexDB(object):
@@ -23,16 +119,61 @@ class IndexDB(object):
   IDX_PAT = re.compile(r'^...\d{5}\.cdb$')
   
   # cdb object cache. Shared among all instances.
-  _cdb_cache = {}
+  # Each entry is keyed by (path, inode, mtime), so a replaced file is
+  # never read through an old object. The number of entries (i.e. open
+  # files) is bounded; an evicted object is closed when it is no longer used.
+  # refresh() enlarges the cache so that all the index files fit in it;
+  # otherwise a sequential scan would evict the next file every time.
+  CDB_CACHE_SIZE = 64
+  _cdb_cache = LRUCache(CDB_CACHE_SIZE)
   @classmethod
   def get_idx(klass, path):
-    if path in klass._cdb_cache:
-      idx = klass._cdb_cache[path]
-    else:
-      idx = cdb.init(path)
-      klass._cdb_cache[path] = idx
+    st = os.stat(path)
+    key = (path, st.st_ino, st.st_mtime)
+    idx = klass._cdb_cache.get(key)
+    if idx == None:
+      idx = cdb.mmapinit(path)
+      klass._cdb_cache.put(key, idx)
     return idx
 
+  # Drops the cached cdb objects of a file.
+  @classmethod
+  def forget_idx(klass, path):
+    for key in klass._cdb_cache.keys():
+      if key[0] == path:
+        klass._cdb_cache.pop(key)
+    return
+
+  # Changes the maximum number of the cached cdb objects.
+  @classmethod
+  def set_cache_size(klass, size):
+    klass._cdb_cache.resize(size)
+    return
+
+  # Returns the statistics of the cdb object cache.
+  @classmethod
+  def cache_stats(klass):
+    c = klass._cdb_cache
+    return dict(size=len(c), maxsize=c.maxsize,
+                hits=c.hits, misses=c.misses, evictions=c.evictions)
+
+  # Deleted docids of each index file: {path: (mtime, DocBitmap)}
+  _deleted_cache = {}
+  @classmethod
+  def get_deleted(klass, path):
+    path = DocBitmap.get_path(path)
+    try:
+      st = os.stat(path)
+      mtime = (st.st_mtime, st.st_size)
+    except OSError:
+      mtime = None
+    if path in klass._deleted_cache:
+      (mtime0, deleted) = klass._deleted_cache[path]
+      if mtime0 == mtime: return deleted
+    deleted = DocBitmap(path)
+    klass._deleted_cache[path] = (mtime, deleted)
+    return deleted
+
   def __init__(self, idxdir, prefix=''):
     self.idxdir = idxdir
     self.prefix = prefix
@@ -46,6 +187,10 @@ class IndexDB(object):
   def reset(self):
     self.mtime = 0
     self.idxs = []
+    self._locidx = None
+    # the locations in the index files written since the last
+    # update of the location index: {fname: ((size,mtime), locs)}
+    self._newlocs = {}
     return
 
   def open(self):
@@ -72,7 +217,12 @@ class IndexDB(object):
   # (Internal) Returns a new cdb maker.
   def add_idx(self, idxid):
     fname = self.gen_idx_fname(idxid)
-    maker = cdb.cdbmake(fname, fname+'.tmp')
+    # remove the deleted docids of an old index file.
+    try:
+      os.unlink(DocBitmap.get_path(fname))
+    except OSError:
+      pass
+    maker = cdb.cdbmake(fname, fname+'.tmp', keyindex=True)
     return (fname, maker)
 
   # (Internal) Returns an iterator for the index files.
@@ -91,6 +241,20 @@ class IndexDB(object):
                          reverse=True)
     if self.idxs:
       self.mtime = os.stat(os.path.join(self.idxdir, self.idxs[0]))[stat.ST_MTIME]
+    self._locidx = None
+    # drop the cached objects of the files replaced or removed.
+    base = os.path.join(self.idxdir, '')
+    for key in self._cdb_cache.keys():
+      (path, ino, mtime) = key
+      if not path.startswith(base): continue
+      try:
+        st = os.stat(path)
+        if (st.st_ino, st.st_mtime) == (ino, mtime): continue
+      except OSError:
+        pass
+      self._cdb_cache.pop(key)
+    if self._cdb_cache.maxsize < len(self.idxs):
+      self.set_cache_size(len(self.idxs))
     return
 
   # Returns the modification time of the indices.
@@ -115,11 +279,276 @@ class IndexDB(object):
       total += ndocs
     return total
 
-  # Returns (i,docid) if the location is already indexed.
-  def loc_indexed(self, loc):
-    for (idxid,idx) in self.iteridxs():
+  # Marks the documents at the given locations as deleted
+  # in all the index files except the one given by "keep".
+  # Only the index files that have the locations are touched.
+  # Returns the number of the documents deleted.
+  def delete_locs(self, locs, keep=None):
+    locs = list(locs)
+    found = {}
+    for (loc,r) in zip(locs, self._locate(locs, skip=keep)):
+      if r == None: continue
+      found.setdefault(r[0], []).append(loc)
+    n = 0
+    for (idxid,locs1) in sorted(found.iteritems()):
+      idx = self.get_idx(os.path.join(self.idxdir, self.idxs[idxid]))
+      deleted = self.get_deleted(idx.name)
+      # a multipart document has several docids.
+      for loc in locs1:
+        for docid in idx_loc2docids(idx, loc):
+          if docid not in deleted:
+            deleted.add(docid)
+            n += 1
+      deleted.save()
+    # "keep" has just been written with these locations;
+    # remember them so that the next call need not probe it.
+    if keep != None:
+      st = os.stat(keep)
+      self._newlocs[os.path.basename(keep)] = ((st.st_size, st.st_mtime), frozenset(locs))
+    return n
+
+  # Location index filename: "xxxloc.cdb"
+  #   PROP_LOC+loc -> docid, mtime and the index filename
+  #   of the latest (not deleted) document at each location.
+  #   PROP_IDXINFO -> the states of the index files it covers.
+  def get_locidx_path(self):
+    return os.path.join(self.idxdir, '%sloc.cdb' % self.prefix)
+
+  # Manifest filename: "xxxmanifest.cdb"
+  def get_manifest_path(self):
+    return os.path.join(self.idxdir, '%smanifest.cdb' % self.prefix)
+
+  # (Internal) Returns the current states (fname, size, mtime) of the index files.
+  def _idxs_states(self):
+    states = []
+    for fname in self.idxs:
+      try:
+        st = os.stat(os.path.join(self.idxdir, fname))
+      except OSError:
+        continue
+      states.append((fname, st.st_size, st.st_mtime))
+    return states
+
+  # (Internal) Returns the location index and the set of the index files
+  # it covers, i.e. the ones unchanged since it was written.
+  # The entries for the other files must be ignored.
+  # The deleted documents are not excluded here.
+  def get_locidx(self):
+    if self._locidx == None:
+      self._locidx = (None, frozenset())
       try:
-        return (idxid, idx_loc2docid(idx, loc))
-      except KeyError:
+        locidx = cdb.mmapinit(self.get_locidx_path())
+        states = set(marshal.loads(locidx[PROP_IDXINFO]))
+      except (IOError, KeyError, ValueError, EOFError, TypeError):
         pass
-    return None
+      else:
+        covered = frozenset( fname for (fname,size,mtime) in self._idxs_states()
+                             if (fname,size,mtime) in states )
+        self._locidx = (locidx, covered)
+    return self._locidx
+
+  # Updates the location index. Only the index files that are not
+  # covered by the current one (i.e. new or merged ones) are scanned;
+  # the other entries are copied unless their documents are deleted.
+  def update_locidx(self):
+    path = self.get_locidx_path()
+    (locidx, covered) = self.get_locidx()
+    idxids = dict( (fname,idxid) for (idxid,fname) in enumerate(self.idxs) )
+    states = self._idxs_states()
+    locs = {}
+    for (idxid,idx) in self.iteridxs():
+      fname = self.idxs[idxid]
+      if fname in covered: continue
+      deleted = self.get_deleted(idx.name)
+      for (k,v) in idx_iterdocinfo(idx):
+        (docid,) = unpack('>i', k[1:])
+        loc = v[4:]
+        # the newer index comes first.
+        if loc in locs or docid in deleted: continue
+        locs[loc] = (idxid, pack('>i', docid)+v[:4]+fname)
+    if locidx:
+      deleted = {}
+      for (k,v) in locidx.scan(PROP_LOC):
+        fname = v[8:]
+        if fname not in covered: continue
+        loc = k[1:]
+        idxid = idxids[fname]
+        if loc in locs and locs[loc][0] < idxid: continue
+        if fname not in deleted:
+          deleted[fname] = self.get_deleted(os.path.join(self.idxdir, fname))
+        (docid,) = unpack('>i', v[:4])
+        if docid in deleted[fname]: continue
+        locs[loc] = (idxid, v)
+    maker = cdb.cdbmake(path, path+'.tmp')
+    maker.addmany( (PROP_LOC+loc, locs[loc][1]) for loc in sorted(locs) )
+    maker.add(PROP_IDXINFO, marshal.dumps(states))
+    maker.finish()
+    self._locidx = None
+    self._newlocs = {}
+    return len(locs)
+
+  # Returns (i,docid) if the location is already indexed.
+  def loc_indexed(self, loc):
+    r = self.locs_indexed([loc])[0]
+    if r == None: return None
+    (idxid, docid, _) = r
+    return (idxid, docid)
+
+  # Looks up multiple locations at once.
+  # Returns a list of (i,docid,mtime) or None for each location.
+  def locs_indexed(self, locs):
+    return self._locate(locs)
+
+  # (Internal) Finds the latest (not deleted) document at each location,
+  # ignoring the index file "skip". Returns a list of (i,docid,mtime) or None.
+  def _locate(self, locs, skip=None):
+    keys = [ PROP_LOC+loc for loc in locs ]
+    r = [ None ] * len(locs)
+    (locidx, covered) = self.get_locidx()
+    if locidx:
+      # one probe per location.
+      idxids = dict( (fname,idxid) for (idxid,fname) in enumerate(self.idxs) )
+      for (i,v) in enumerate(locidx.get_many(keys)):
+        if v == None: continue
+        fname = v[8:]
+        if fname not in covered: continue
+        (docid, mtime) = unpack('>ii', v[:8])
+        if docid in self.get_deleted(os.path.join(self.idxdir, fname)): continue
+        r[i] = (idxids[fname], docid, mtime)
+    # probe the index files not covered by the location index.
+    for (idxid,fname) in enumerate(self.idxs):
+      if fname in covered: continue
+      path = os.path.join(self.idxdir, fname)
+      if path == skip: continue
+      # the newer index comes first.
+      rest = [ i for (i,x) in enumerate(r) if x == None or idxid < x[0] ]
+      if fname in self._newlocs and rest:
+        (state, newlocs) = self._newlocs[fname]
+        st = os.stat(path)
+        if state == (st.st_size, st.st_mtime):
+          rest = [ i for i in rest if locs[i] in newlocs ]
+      if not rest: continue
+      idx = self.get_idx(path)
+      deleted = self.get_deleted(path)
+      for (i,v) in zip(rest, idx.get_many( keys[i] for i in rest )):
+        if v == None: continue
+        (docid,) = unpack('>i', v)
+        if docid in deleted: continue
+        (_,mtime) = idx_docid2info(idx, docid)
+        r[i] = (idxid, docid, mtime)
+    return r
+
+# test
+def test(argv):
+  import unittest, shutil, gc, weakref
+  from utils import PROP_DOCID
+  dirname = './test_indexdb/'
+
+  class TestIndexDB(unittest.TestCase):
+
+    def setUp(self):
+      shutil.rmtree(dirname, True)
+      self.cdb_cache = IndexDB._cdb_cache
+      IndexDB._cdb_cache = LRUCache(IndexDB.CDB_CACHE_SIZE)
+      self.indexdb = IndexDB(dirname, 'idx')
+      self.indexdb.create()
+      return
+
+    def tearDown(self):
+      IndexDB._cdb_cache = self.cdb_cache
+      shutil.rmtree(dirname, True)
+      return
+
+    def add_idx(self, idxid, value):
+      (_, maker) = self.indexdb.add_idx(idxid)
+      maker.add('key', value)
+      maker.finish()
+      return
+
+    # mtime of each document = idxid.
+    def add_docs(self, idxid, locs):
+      (_, maker) = self.indexdb.add_idx(idxid)
+      docs = list(enumerate(locs, 1))
+      maker.addmany( (pack('>ci', PROP_DOCID, docid), pack('>i', idxid)+loc)
+                     for (docid,loc) in docs )
+      maker.addmany( (PROP_LOC+loc, pack('>i', docid))
+                     for (docid,loc) in sorted(docs, key=lambda (_,loc): loc) )
+      maker.add(PROP_IDXINFO, pack('>ii', len(docs), 0))
+      maker.finish()
+      return
+
+    def test_locidx(self):
+      locs = ['a', 'b', 'c', 'd']
+      self.add_docs(0, ['a', 'b'])
+      self.add_docs(1, ['b', 'c'])
+      self.indexdb.open()
+      self.assertEqual(self.indexdb.update_locidx(), 3)
+      self.assertEqual(self.indexdb.locs_indexed(locs), [(1,1,0), (0,1,1), (0,2,1), None])
+      # a new index file is looked up before the location index is updated.
+      self.add_docs(2, ['a', 'd'])
+      deleted = self.indexdb.get_deleted(self.indexdb.gen_idx_fname(0))
+      deleted.add(1)
+      deleted.save()
+      self.indexdb.refresh()
+      r = [(0,1,2), (1,1,1), (1,2,1), (0,2,2)]
+      self.assertEqual(self.indexdb.locs_indexed(locs), r)
+      self.assertEqual(self.indexdb.loc_indexed('a'), (0,1))
+      # only the new index file is scanned.
+      self.assertEqual(self.indexdb.get_locidx()[1], set(['idx00000.cdb', 'idx00001.cdb']))
+      self.assertEqual(self.indexdb.update_locidx(), 4)
+      self.assertEqual(self.indexdb.get_locidx()[1], set(self.indexdb.idxs))
+      self.assertEqual(self.indexdb.locs_indexed(locs), r)
+      # the deleted documents are dropped.
+      deleted = self.indexdb.get_deleted(self.indexdb.gen_idx_fname(1))
+      deleted.add(2)
+      deleted.save()
+      self.assertEqual(self.indexdb.update_locidx(), 3)
+      self.assertEqual(self.indexdb.locs_indexed(locs), [(0,1,2), (1,1,1), None, (0,2,2)])
+      return
+
+    def test_cache(self):
+      n = IndexDB.CDB_CACHE_SIZE+5
+      for i in xrange(n):
+        self.add_idx(i, str(i))
+      self.indexdb.open()
+      # all the index files fit in the cache.
+      for _ in xrange(3):
+        self.assertEqual(len(list(self.indexdb.iteridxs())), n)
+      stats = self.indexdb.cache_stats()
+      self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (n*2, n, 0))
+      return
+
+    def test_evict(self):
+      n = 20
+      for i in xrange(n):
+        self.add_idx(i, str(i))
+      self.indexdb.open()
+      IndexDB.set_cache_size(4)
+      refs = []
+      for (_,idx) in self.indexdb.iteridxs():
+        refs.append(weakref.ref(idx))
+      del idx
+      gc.collect()
+      # the evicted objects are released.
+      self.assertEqual(len([ r for r in refs if r() != None ]), 4)
+      self.assertEqual(self.indexdb.cache_stats()['evictions'], n-4)
+      return
+
+    def test_refresh(self):
+      self.add_idx(0, 'old')
+      self.indexdb.open()
+      path = self.indexdb.gen_idx_fname(0)
+      self.assertEqual(IndexDB.get_idx(path).get('key'), 'old')
+      # a replaced file is read again after refresh().
+      self.add_idx(0, 'new')
+      self.assertEqual(IndexDB.get_idx(path).get('key'), 'new')
+      # refresh() drops the old object.
+      self.indexdb.refresh()
+      self.assertEqual(self.indexdb.cache_stats()['size'], 1)
+      return
+
+  suite = unittest.TestSuite()
+  suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(TestIndexDB))
+  return not unittest.TextTestRunner(verbosity=2).run(suite).wasSuccessful()
+
+if __name__ == '__main__': sys.exit(test(sys.argv))
@@ -4,10 +4,11 @@
 ##
 
 import sys, time
-from struct import pack
+from struct import pack, unpack
 from array import array
-from utils import encode_array, zen2han, rmsp
-from utils import PROP_SENT, PROP_DOCID, PROP_LOC, PROP_IDXINFO, PROP_LABEL
+from heapq import merge
+from utils import encode_array, encode_sents, zen2han, rmsp, LRUCache
+from utils import PROP_SENT, PROP_SENTS, PROP_DOCID, PROP_LOC, PROP_IDXINFO, PROP_LABEL
 from indexdb import IndexDB
 
 
@@ -16,16 +17,106 @@ __all__ = [
   ]
 
 
+# terms: {term: array([docid0,sentid0, docid1,sentid1, ...])}
+# The postings of each term are appended in ascending order.
 def add_features(terms, docid, sentid, feats):
   for w in feats:
     if w not in terms:
-      occs = []
+      occs = array('i')
       terms[w] = occs
     else:
       occs = terms[w]
-    occs.append((docid, sentid))
+    occs.append(docid)
+    occs.append(sentid)
   return
 
+# Returns the (docid,sentid) pairs in the reverse order.
+def reverse_pairs(a):
+  r = array('i', a)
+  r.reverse()
+  (r[0::2], r[1::2]) = (r[1::2], r[0::2])
+  return r
+
+# Writes the postings in the term order (a sorted run).
+def write_run(fp, terms):
+  for w in sorted(terms.iterkeys()):
+    data = terms[w].tostring()
+    fp.write(pack('>ii', len(w), len(data)))
+    fp.write(w)
+    fp.write(data)
+  return
+
+# Reads a sorted run and yields (term, runid, postings).
+def read_run(fp, runid):
+  fp.seek(0)
+  while 1:
+    x = fp.read(8)
+    if not x: break
+    (wlen, n) = unpack('>ii', x)
+    w = fp.read(wlen)
+    a = array('i')
+    a.fromstring(fp.read(n))
+    yield (w, runid, a)
+  return
+
+# Normalizes a sentence and returns (sent, terms), where sent is
+# encoded in utf-8. If memo (LRUCache) is given, the results are
+# memoized by the original sentence, as the same sentences
+# (signatures, quotations, footers, etc.) appear again and again.
+def analyze_sent(doc, sent, memo=None):
+  if memo != None:
+    key = (doc.__class__, doc.get_indexstyle(), sent)
+    r = memo.get(key)
+    if r != None: return r
+  s = zen2han(rmsp(sent))
+  r = (s.encode('utf-8'), tuple(set(doc.splitterms(s))))
+  if memo != None:
+    memo.put(key, r)
+  return r
+
+# Reads a document and its subdocuments (in this order) and returns
+# a list of (loc, mtime, feats, sents) for each of them.
+# sents is a list of (sent, terms), where sent is encoded in utf-8.
+def analyze_doc(corpus, doc, maxsents=100000, memo=None):
+  feats = [ PROP_LABEL+x for x in corpus.loc_labels(doc.loc) ]
+  feats.extend(doc.get_feats())
+  sents = []
+  title = doc.get_title()
+  if title and len(sents) < maxsents:
+    sents.append(analyze_sent(doc, title, memo))
+  for sent in doc.get_sents():
+    (sent, terms) = analyze_sent(doc, sent, memo)
+    if not sent: continue
+    sents.append((sent, terms))
+    if maxsents <= len(sents): break
+  r = [(doc.loc, doc.get_mtime(), feats, sents)]
+  for subdoc in doc.get_subdocs():
+    if subdoc:
+      r.extend(analyze_doc(corpus, subdoc, maxsents=maxsents, memo=memo))
+  return r
+
+# Worker process for parallel indexing.
+# Each worker has its own memo and reports its hits and misses.
+_worker_corpus = None
+_worker_memo = None
+def _worker_init(corpus, memo_size):
+  global _worker_corpus, _worker_memo
+  # do not share the file handles with the parent process.
+  corpus.reopen()
+  _worker_corpus = corpus
+  if memo_size:
+    _worker_memo = LRUCache(memo_size)
+  return
+def _worker_analyze((loc, maxsents)):
+  doc = _worker_corpus.get_doc(loc)
+  if not doc: return (None, 0, 0)
+  memo = _worker_memo
+  if memo == None:
+    return (analyze_doc(_worker_corpus, doc, maxsents=maxsents), 0, 0)
+  (hits, misses) = (memo.hits, memo.misses)
+  r = analyze_doc(_worker_corpus, doc, maxsents=maxsents, memo=memo)
+  return (r, memo.hits-hits, memo.misses-misses)
+
 def linux_process_memory():
   v = None
   try:
@@ -37,7 +128,13 @@ def linux_process_memory():
   except IOError:
     pass
   return v
-  
+
+# The estimated memory used by the postings in Indexer.terms:
+# each term costs the key, the array object and the dict entry,
+# and each (docid,sentid) pair costs two ints.
+TERM_OVERHEAD = 160
+PAIR_SIZE = 8
+
 
 
 ##  Indexer
@@ -47,6 +144,11 @@ class Indexer(object):
   def __init__(self, indexdb, corpus, 
                max_docs_threshold=1000,
                max_terms_threshold=50000,
+               max_memory_threshold=0,
+               spill=False,
+               manifest=None,
+               memo_size=10000,
+               sentblock=False,
                verbose=0):
     assert len(indexdb.prefix) == 3
     self.indexdb = indexdb
@@ -54,24 +156,64 @@ class Indexer(object):
     self.idx_count = len(self.indexdb.idxs)
     self.max_docs_threshold = max_docs_threshold
     self.max_terms_threshold = max_terms_threshold
+    # the memory (in kilobytes) allowed for the postings of an index.
+    self.max_memory_threshold = max_memory_threshold
+    self._npairs = 0
+    # if spill is True, the postings are written to temporary files
+    # instead of starting a new index when the memory exceeds.
+    self.spill = spill
+    self._runs = []
+    # if manifest is given, the indexed documents are fingerprinted
+    # and an unchanged document is not read again.
+    self.manifest = manifest
+    # recently analyzed sentences (memo_size=0 disables it).
+    self.memo_size = memo_size
+    self.memo = None
+    if memo_size:
+      self.memo = LRUCache(memo_size)
+    # if sentblock is True, the sentences of each document are
+    # compressed into one block instead of one key per sentence.
+    self.sentblock = sentblock
     self.verbose = verbose
-    # (docid,doc) mappings in the current index.
+    # (docid,loc,mtime) of the documents in the current index.
     # docid is local to each index.
     self.docinfo = []
     # terms indexed in the current index.
     self.terms = {}
     # cdbmaker
     self.maker = None
+    self.fname = None
     return
 
   # Adds a new index file.
   def create_new_idx(self):
     (fname, self.maker) = self.indexdb.add_idx(self.idx_count)
+    self.fname = fname
     self.idx_count += 1
     if self.verbose:
       print >>sys.stderr, 'Building index %r(%d)...' % (fname, self.idx_count)
     return
 
+  # Returns True if the document at the location has changed since
+  # it was recorded in the manifest, and records its new fingerprint.
+  # The contents are compared only when the mtime or size differs.
+  def loc_changed(self, loc):
+    (mtime, size) = (self.corpus.loc_mtime(loc), self.corpus.loc_size(loc))
+    r = self.manifest.get(loc)
+    if r != None and mtime and r[:2] == (mtime, size): return False
+    digest = self.corpus.loc_digest(loc)
+    self.manifest.set(loc, mtime, size, digest)
+    return r == None or r[2] != digest
+
+  # Removes the unchanged documents that are already indexed.
+  def filter_locs(self, locs):
+    changed = [ self.loc_changed(loc) for loc in locs ]
+    indexed = self.indexdb.locs_indexed(locs)
+    r = [ loc for (loc,c,i) in zip(locs, changed, indexed) if c or not i ]
+    if self.verbose:
+      print >>sys.stderr, 'Manifest: %d/%d documents changed' % (len(r), len(locs))
+    return r
+
   # Index a new Document at a given location.
   def index_loc(self, loc, maxsents=100000):
     doc = self.corpus.get_doc(loc)
@@ -79,41 +221,116 @@ class Indexer(object):
     return self.index_doc(doc, maxsents=maxsents)
   
   def index_doc(self, doc, maxsents=100000):
+    for x in analyze_doc(self.corpus, doc, maxsents=maxsents, memo=self.memo):
+      self.add_doc(x)
+    return True
+
+  # Index documents at the given locations with nworkers processes.
+  # The documents are read and tokenized by the workers, but they are
+  # added in the given order, so the result is the same as index_loc().
+  def index_locs(self, locs, maxsents=100000, nworkers=1):
+    if self.manifest != None:
+      locs = self.filter_locs(list(locs))
+    if nworkers <= 1:
+      for loc in locs:
+        self.index_loc(loc, maxsents=maxsents)
+      return
+    from multiprocessing import Pool
+    pool = Pool(nworkers, _worker_init, (self.corpus, self.memo_size))
+    try:
+      for (r, hits, misses) in pool.imap(_worker_analyze, ( (loc, maxsents) for loc in locs ), 4):
+        if self.memo != None:
+          self.memo.hits += hits
+          self.memo.misses += misses
+        if not r: continue
+        for x in r:
+          self.add_doc(x)
+      pool.close()
+    finally:
+      pool.terminate()
+      pool.join()
+    return
+
+  # Adds an analyzed document: (loc, mtime, feats, sents).
+  def add_doc(self, (loc, mtime, feats, sents)):
     if self.maker == None:
       self.create_new_idx()
     docid = len(self.docinfo)+1
-    self.docinfo.append((docid, doc))
+    self.docinfo.append((docid, loc, mtime))
     if 2 <= self.verbose:
-      print >>sys.stderr, 'Reading: %r' % doc
+      print >>sys.stderr, 'Reading: %r' % loc
     elif 1 <= self.verbose:
       sys.stderr.write('.'); sys.stderr.flush()
     terms = self.terms
     # other features
-    add_features(terms, docid, 0,
-                 ( PROP_LABEL+x for x in self.corpus.loc_labels(doc.loc) ))
-    add_features(terms, docid, 0, doc.get_feats())
+    add_features(terms, docid, 0, feats)
+    self._npairs += len(feats)
     # sents
-    sentid = 0
-    title = doc.get_title()
-    if title and sentid < maxsents:
-      title = zen2han(rmsp(title))
-      self.maker.add(pack('>cii', PROP_SENT, docid, sentid), title.encode('utf-8'))
-      add_features(terms, docid, sentid, set(doc.splitterms(title)))
-      sentid += 1
-    for sent in doc.get_sents():
-      sent = zen2han(rmsp(sent))
-      if not sent: continue
-      self.maker.add(pack('>cii', PROP_SENT, docid, sentid), sent.encode('utf-8'))
-      add_features(terms, docid, sentid, set(doc.splitterms(sent)))
-      sentid += 1
-      if maxsents <= sentid: break
+    if self.sentblock:
+      if sents:
+        self.maker.add(pack('>ci', PROP_SENTS, docid),
+                       encode_sents([ sent for (sent,_) in sents ]))
+    else:
+      for (sentid,(sent,_)) in enumerate(sents):
+        self.maker.add(pack('>cii', PROP_SENT, docid, sentid), sent)
+    for (sentid,(_,ws)) in enumerate(sents):
+      add_features(terms, docid, sentid, ws)
+      self._npairs += len(ws)
     if ((self.max_docs_threshold and self.max_docs_threshold <= len(self.docinfo)) or 
         (self.max_terms_threshold and self.max_terms_threshold <= len(terms))):
       self.flush()
-    for subdoc in doc.get_subdocs():
-      if subdoc:
-        self.index_doc(subdoc, maxsents=maxsents)
-    return True
+    elif self._memory_exceeded():
+      if self.spill:
+        self._spill()
+      else:
+        self.flush()
+    return
+
+  # (Internal) Returns the estimated size of the postings in memory (in kilobytes).
+  def _memory_used(self):
+    return (len(self.terms)*TERM_OVERHEAD + self._npairs*PAIR_SIZE) / 1024
+
+  # (Internal) Returns True if the postings in memory exceed max_memory_threshold.
+  # (The process RSS is not used; it hardly shrinks after a flush.)
+  def _memory_exceeded(self):
+    if not self.max_memory_threshold: return False
+    return self.max_memory_threshold <= self._memory_used()
+
+  # (Internal) Writes the postings in memory to a temporary file.
+  def _spill(self):
+    import tempfile
+    fp = tempfile.TemporaryFile(prefix='spill', dir=self.indexdb.idxdir)
+    write_run(fp, self.terms)
+    fp.flush()
+    self._runs.append(fp)
+    if self.verbose:
+      print >>sys.stderr, 'spill: run=%d, keys=%d, memory=%s' % \
+            (len(self._runs), len(self.terms), linux_process_memory())
+    self.terms.clear()
+    self._npairs = 0
+    return
+
+  # (Internal) Iterates (term, postings) in the term order,
+  # merging the spilled runs and the postings in memory.
+  def _iterterms(self):
+    if not self._runs:
+      for w in sorted(self.terms.iterkeys()):
+        yield (w, self.terms[w])
+      return
+    runs = [ read_run(fp, runid) for (runid,fp) in enumerate(self._runs) ]
+    runid = len(runs)
+    runs.append( (w, runid, self.terms[w]) for w in sorted(self.terms.iterkeys()) )
+    (w0, occs) = (None, None)
+    for (w, _, a) in merge(*runs):
+      if w != w0:
+        if occs != None: yield (w0, occs)
+        (w0, occs) = (w, array('i'))
+      occs.extend(a)
+    if occs != None: yield (w0, occs)
+    for fp in self._runs:
+      fp.close()
+    self._runs = []
+    return
 
   # Build a cdb file.
   def flush(self):
@@ -122,40 +339,121 @@ class Indexer(object):
     t0 = time.time()
     # All keys must be lexically sorted except the last one.
     # DocID -> Document.
-    self.docinfo.sort(key=lambda (docid,_): docid)
+    self.docinfo.sort()
     # Term -> pos.
     nrefs = 0
-    for w in sorted(self.terms.iterkeys()):
-      occs = self.terms[w]
-      occs.sort(reverse=True)
-      a = array('i')
-      for (docid,pos) in occs:
-        a.append(docid)
-        a.append(pos)
-      self.maker.add(w, encode_array(len(occs), a))
-      nrefs += len(occs)
+    nterms = 0
+    for (w,occs) in self._iterterms():
+      self.maker.add(w, encode_array(len(occs)/2, reverse_pairs(occs)))
+      nrefs += len(occs)/2
+      nterms += 1
     # location -> DocID
-    for (docid,doc) in self.docinfo:
-      self.maker.add(pack('>ci', PROP_DOCID, docid), pack('>i', doc.get_mtime())+doc.loc)
-    self.docinfo.sort(key=lambda (_,doc): doc.loc)
+    self.maker.addmany( (pack('>ci', PROP_DOCID, docid), pack('>i', mtime)+loc)
+                        for (docid,loc,mtime) in self.docinfo )
+    self.docinfo.sort(key=lambda (_,loc,mtime): loc)
     # DocID -> location
-    for (docid,doc) in self.docinfo:
-      self.maker.add(PROP_LOC+doc.loc, pack('>i', docid))
+    self.maker.addmany( (PROP_LOC+loc, pack('>i', docid))
+                        for (docid,loc,mtime) in self.docinfo )
     # The number of documents
-    self.maker.add(PROP_IDXINFO, pack('>ii', len(self.docinfo), len(self.terms)))
+    self.maker.add(PROP_IDXINFO, pack('>ii', len(self.docinfo), nterms))
     self.maker.finish()
     self.maker = None
+    # The older versions of the documents are marked as deleted.
+    self.indexdb.refresh()
+    ndels = self.indexdb.delete_locs(set( loc for (_,loc,_) in self.docinfo ), keep=self.fname)
     if self.verbose:
       t = time.time() - t0
-      print >>sys.stderr, 'docs=%d, keys=%d, refs=%d, time=%.1fs(%.1fdocs/s), memory=%s' % \
-            (len(self.docinfo), len(self.terms), nrefs, t, len(self.docinfo)/t,
+      print >>sys.stderr, 'docs=%d, keys=%d, refs=%d, dels=%d, time=%.1fs(%.1fdocs/s), memory=%s' % \
+            (len(self.docinfo), nterms, nrefs, ndels, t, len(self.docinfo)/t,
              linux_process_memory())
+      if self.memo != None:
+        lookups = self.memo.hits+self.memo.misses
+        print >>sys.stderr, 'memo: hits=%d/%d(%.1f%%), size=%d' % \
+              (self.memo.hits, lookups, 100.0*self.memo.hits/max(1, lookups), len(self.memo))
     # Clear the files and terms.
     self.docinfo = []
     self.terms.clear()
+    self._npairs = 0
     return
 
   def finish(self):
     self.flush()
+    if self.manifest != None:
+      self.manifest.save()
     self.indexdb.refresh()
+    self.indexdb.update_locidx()
     return
+
+
+# test
+def test(argv):
+  import unittest
+  import os, shutil
+  from corpus import FilesystemCorpus
+  from document import PlainTextDocument
+  from utils import idx_info
+  dirname = './test_indexer/'
+
+  class TestIndexer(unittest.TestCase):
+
+    def setUp(self):
+      shutil.rmtree(dirname, True)
+      os.makedirs(os.path.join(dirname, 'src'))
+      # documents of the same size with distinct words.
+      for i in xrange(40):
+        fp = file(os.path.join(dirname, 'src', 'doc%02d.txt' % i), 'w')
+        fp.write(' '.join( 'w%dx%d' % (i,j) for j in xrange(20) )+'\n')
+        fp.close()
+      self.indexdb = IndexDB(os.path.join(dirname, 'idx'), 'idx')
+      self.indexdb.create()
+      self.indexdb.open()
+      return
+
+    def tearDown(self):
+      shutil.rmtree(dirname, True)
+      return
+
+    def test_memory(self):
+      corpus = FilesystemCorpus(os.path.join(dirname, 'src'), PlainTextDocument, 'ascii')
+      indexer = Indexer(self.indexdb, corpus, 0, 0, max_memory_threshold=20)
+      for i in xrange(40):
+        indexer.index_loc('doc%02d.txt' % i)
+      indexer.finish()
+      # every index file but the last one has the same number of documents.
+      ndocs = [ idx_info(idx)[0] for (_,idx) in self.indexdb.iteridxs() ]
+      self.assertTrue(4 <= len(ndocs))
+      self.assertEqual(sum(ndocs), 40)
+      self.assertEqual(len(set(ndocs[1:])), 1)
+      self.assertTrue(ndocs[0] <= ndocs[1])
+      return
+
+    def test_multipart(self):
+      from merger import Merger, LinearMergePolicy
+      from utils import idx_loc2docids
+      corpus = FilesystemCorpus(os.path.join(dirname, 'src'), PlainTextDocument, 'ascii')
+      indexer = Indexer(self.indexdb, corpus, 0, 0)
+      # a document with two parts, and another one in the next index.
+      indexer.add_doc(('m', 1, [], [('part1', ('p1',))]))
+      indexer.add_doc(('m', 1, [], [('part2', ('p2',))]))
+      indexer.flush()
+      indexer.add_doc(('x', 1, [], [('x', ('x',))]))
+      indexer.finish()
+      Merger(self.indexdb, 0, 0, policy=LinearMergePolicy(0, 0)).run()
+      self.assertEqual(self.indexdb.idxs, ['idx00000.cdb'])
+      (_,idx) = list(self.indexdb.iteridxs())[0]
+      docids = idx_loc2docids(idx, 'm')
+      self.assertEqual(len(docids), 2)
+      # re-indexing the document deletes all the parts.
+      indexer = Indexer(self.indexdb, corpus, 0, 0)
+      indexer.add_doc(('m', 2, [], [('part1', ('p1',))]))
+      indexer.finish()
+      self.assertEqual([ docid in self.indexdb.get_deleted(idx.name) for docid in docids ],
+                       [True, True])
+      self.assertEqual(self.indexdb.loc_indexed('m'), (0, 1))
+      return
+
+  suite = unittest.TestSuite()
+  suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(TestIndexer))
+  return not unittest.TextTestRunner(verbosity=2).run(suite).wasSuccessful()
+
+if __name__ == '__main__': sys.exit(test(sys.argv))
@@ -3,25 +3,102 @@
 ##  merger.py
 ##
 
-import sys, os, os.path
+import sys, os, os.path, time, mmap, tempfile, audioop
 from array import array
-from struct import pack, unpack
+from itertools import chain
+from struct import pack, unpack, unpack_from
 import pycdb as cdb
-from utils import encode_array, decode_array, idx_info
-from utils import PROP_SENT, PROP_DOCID, PROP_LOC, PROP_IDXINFO
+from indexdb import IndexDB, DocBitmap
+from utils import encode_array, decode_array, idx_info, idx_iterdocinfo, idx_iterlocs
+from utils import PROP_SENT, PROP_SENTS, PROP_DOCID, PROP_LOC, PROP_IDXINFO
 
 
 __all__ = [
-  'Merger'
+  'Merger', 'MergePolicy', 'LinearMergePolicy', 'TieredMergePolicy'
   ]
 
 
+# The maximum number of indices merged at once.
+MERGE_FANIN = 32
+
 # Estimate the number of unique terms:
 # assuming roughly 25% of the words are common.
 def estimate_terms(nterms):
   return reduce(lambda r,n: r + max(n - int(r*0.25), 0), nterms, 0)
 
 
+# Adds d to every docid of (docid,sentid) pairs in place.
+# audioop.bias() adds a constant to every 32-bit sample in C.
+def rebase_docids(a, d):
+  b = array('i')
+  b.fromstring(audioop.bias(a[0::2].tostring(), 4, d))
+  a[0::2] = b
+  return a
+
+
+##  DocIdMap
+##
+##  A table of old docid -> new docid (0 for the dropped documents).
+##  The entries are added in the ascending order of old docids.
+##  A large table is spilled to a temporary file and mapped into
+##  memory, so that it does not stay in the process heap.
+##
+class DocIdMap(object):
+
+  # the number of entries kept in memory.
+  SPILL_THRESHOLD = 1<<20
+
+  def __init__(self):
+    self._a = array('i')
+    self._fp = None
+    self._map = None
+    self.size = 0
+    return
+
+  def __repr__(self):
+    return '<DocIdMap: size=%d, spilled=%r>' % (self.size, self._fp != None)
+
+  def set(self, oldid, newid):
+    assert self.size <= oldid
+    a = self._a
+    if self.size < oldid:
+      a.extend(array('i', [0]) * (oldid-self.size))
+    a.append(newid)
+    self.size = oldid+1
+    if self.SPILL_THRESHOLD <= len(a):
+      self.spill()
+    return
+
+  def spill(self):
+    if self._fp == None:
+      self._fp = tempfile.TemporaryFile()
+    self._a.tofile(self._fp)
+    self._a = array('i')
+    return
+
+  def finish(self):
+    if self._fp != None:
+      self.spill()
+      self._fp.flush()
+      self._map = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+    return
+
+  def close(self):
+    if self._map != None:
+      self._map.close()
+      self._map = None
+    if self._fp != None:
+      self._fp.close()
+      self._fp = None
+    self._a = array('i')
+    return
+
+  def get(self, oldid):
+    if oldid < 0 or self.size <= oldid: return 0
+    if self._map == None: return self._a[oldid]
+    return unpack_from('=i', self._map, oldid*4)[0]
+
+
 ##  IndexFile
 ##
 class IndexFile(object):
@@ -29,6 +106,7 @@ class IndexFile(object):
   def __init__(self, fname):
     self.fname = fname
     self.cdb = None
+    self.docmap = None
     return
 
   def __repr__(self):
@@ -36,76 +114,134 @@ class IndexFile(object):
 
   def open(self):
     if not self.cdb:
-      self.cdb = cdb.init(self.fname)
+      self.cdb = cdb.mmapinit(self.fname)
       (self.ndocs, self.nterms) = idx_info(self.cdb)
+      self.deleted = DocBitmap(DocBitmap.get_path(self.fname))
     return
 
+  # The number of documents and terms are still available after closing.
   def close(self):
-    self.cdb.close()
+    if self.cdb:
+      self.cdb.close()
+      self.cdb = None
+    if self.docmap:
+      self.docmap.close()
+      self.docmap = None
     return
 
-  def assignnewids1(self, newids):
-    self.oldids = []
-    for (k,v) in self.cdb.iteritems(startkey=pack('>ci', PROP_DOCID, 1)):
-      if k[0] == PROP_LOC: break
-      loc = v[4:]
-      if loc in newids: continue
+  # Assigns new ids to the documents in ascending order, starting from base+1.
+  # The documents in self.purged are dropped. Returns the last new id.
+  def assignnewids(self, base):
+    self.docmap = DocIdMap()
+    self.dropped = 0
+    # If no document is dropped and the old ids are consecutive,
+    # every new id is the old id plus a constant offset, so the ids
+    # can be converted in bulk. (The offset is zero for the oldest index.)
+    offsets = set()
+    newid = base
+    for (k,_) in idx_iterdocinfo(self.cdb):
       (oldid,) = unpack('>xi', k)
-      self.oldids.append((oldid, loc))
-    #assert self.ndocs == len(self.oldids), (self.ndocs, self.oldids)
-    for (oldid,loc) in sorted(self.oldids, reverse=True):
-      newid = len(newids)
-      newids[loc] = newid
-    return
-  def assignnewids2(self, newids):
-    self.old2new = {}
-    for (oldid,loc) in self.oldids:
-      self.old2new[oldid] = newids[loc]
+      if oldid in self.purged:
+        self.dropped += 1
+        continue
+      newid += 1
+      self.docmap.set(oldid, newid)
+      if len(offsets) < 2:
+        offsets.add(newid-oldid)
+    self.docmap.finish()
+    self.offset = None
+    if not self.dropped:
+      if not offsets:
+        self.offset = 0
+      elif len(offsets) == 1:
+        self.offset = offsets.pop()
+    return newid
+
+  # (Internal) Iterates the records of the next section in the file.
+  # The sections before the terms are read in one sequential scan,
+  # so that a file without the key index is not scanned repeatedly.
+  def _itersection(self, c):
+    if self._rest == None:
+      self._rest = self.cdb.iterrange()
+      self._head = next(self._rest, None)
+    while self._head != None and self._head[0][0] == c:
+      yield self._head
+      self._head = next(self._rest, None)
     return
 
   def copysents(self, maker):
-    for (k,v) in self.cdb.iteritems():
-      if k[0] != PROP_SENT: break
-      (oldid, pos) = unpack('>xii', k)
-      if oldid in self.old2new:
-        maker.add(pack('>cii', PROP_SENT, self.old2new[oldid], pos), v)
+    self._rest = None
+    def convert():
+      get = self.docmap.get
+      for (k,v) in self._itersection(PROP_SENT):
+        (oldid, pos) = unpack('>xii', k)
+        newid = get(oldid)
+        if newid:
+          yield (pack('>cii', PROP_SENT, newid, pos), v)
+      return
+    if self.offset == 0:
+      maker.addmany(self._itersection(PROP_SENT))
+    else:
+      maker.addmany(convert())
+    return
+
+  # Sentence blocks are copied as they are.
+  def copysentblocks(self, maker):
+    def convert():
+      get = self.docmap.get
+      for (k,v) in self._itersection(PROP_SENTS):
+        (oldid,) = unpack('>xi', k)
+        newid = get(oldid)
+        if newid:
+          yield (pack('>ci', PROP_SENTS, newid), v)
+      return
+    if self.offset == 0:
+      maker.addmany(self._itersection(PROP_SENTS))
     else:
-      raise ValueError('empty index')
-    self.next = self.cdb.iteritems(startkey=k).next
+      maker.addmany(convert())
+    # the rest of the keys are merged.
+    self.next = chain(filter(None, [self._head]), self._rest).next
+    return
+
+  def copydocids(self, maker):
+    def convert():
+      get = self.docmap.get
+      for (k,v) in idx_iterdocinfo(self.cdb):
+        (oldid,) = unpack('>xi', k)
+        newid = get(oldid)
+        if newid:
+          yield (pack('>ci', PROP_DOCID, newid), v)
+      return
+    maker.addmany(convert())
     return
 
   def convertoldids(self, bits):
     a = decode_array(bits)
+    if self.offset == 0:
+      return a
+    if self.offset != None:
+      rebase_docids(a, self.offset)
+      return a
+    get = self.docmap.get
     r = array('i')
     for i in xrange(0, len(a), 2):
-      if a[i] in self.old2new:
-        r.append(self.old2new[a[i]])
+      newid = get(a[i])
+      if newid:
+        r.append(newid)
         r.append(a[i+1])
     return r
 
 
 # cdbmerge
 def cdbmerge(idxs):
-  q = []
-  for idx in idxs:
-    try:
-      q.append((idx.next(), idx))
-    except StopIteration:
-      pass
   k0 = None
   vs = None
-  while q:
-    q.sort()
-    ((k,v), idx) = q.pop(0)
+  for ((k,v),i) in cdb.kmerge(idxs):
     if k0 != k:
       if vs: yield (k0,vs)
       vs = []
-    vs.append((v, idx))
+    vs.append((v, idxs[i]))
     k0 = k
-    try:
-      q.append((idx.next(), idx))
-    except StopIteration:
-      continue
   if vs: yield (k0,vs)
   return
 
@@ -114,19 +250,76 @@ def cdbmerge(idxs):
 ##
 ##  idxs: a list of indices to merge (the oldest index first).
 ##
-def idxmerge(cdbname, idxstomerge, verbose=0):
-  # Count all the unique locations and assign new document ids.
-  idxorder = {}
-  loc2docid = {}
-  for (i,idx) in enumerate(reversed(idxstomerge)):
-    idx.assignnewids1(loc2docid)
-    idxorder[idx] = i
-  n = len(loc2docid)
-  loc2docid = dict( (loc,n-docid) for (loc,docid) in loc2docid.iteritems() )
+##  The inputs are opened only while they are merged. When there are
+##  more than fanin inputs, adjacent inputs are merged into temporary
+##  index files first, so that the number of open files is bounded.
+##
+def idxmerge(cdbname, idxstomerge, verbose=0, fanin=MERGE_FANIN):
+  assert 2 <= fanin
+  if len(idxstomerge) <= fanin:
+    idxmerge1(cdbname, idxstomerge, verbose)
+    return
+  tmps = []
+  try:
+    level = 0
+    while fanin < len(idxstomerge):
+      idxs = []
+      for i in xrange(0, len(idxstomerge), fanin):
+        group = idxstomerge[i:i+fanin]
+        if len(group) == 1:
+          idxs.extend(group)
+          continue
+        fname = '%s.%d.%d.cdb' % (cdbname, level, i/fanin)
+        tmps.append(fname)
+        idxmerge1(fname, group, verbose)
+        idx = IndexFile(fname)
+        idx.open()
+        idx.close()
+        idxs.append(idx)
+      idxstomerge = idxs
+      level += 1
+    idxmerge1(cdbname, idxstomerge, verbose)
+  finally:
+    for fname in tmps:
+      for fname in (fname, fname+'.tmp'):
+        if os.path.exists(fname):
+          os.unlink(fname)
+  return
+
+def idxmerge1(cdbname, idxstomerge, verbose=0):
+  t0 = time.time()
   for idx in idxstomerge:
-    idx.assignnewids2(loc2docid)
+    idx.open()
+    # purge the deleted documents.
+    idx.purged = DocBitmap(idx.deleted.path)
+  # purge the documents whose location is found in a newer index.
+  def purgelocs():
+    k0 = None
+    ents = []
+    for ((k,v),i) in cdb.kmerge([ idx_iterlocs(idx.cdb) for idx in idxstomerge ]):
+      if k != k0:
+        yield ents
+        ents = []
+        k0 = k
+      (docid,) = unpack('>i', v)
+      ents.append((i, docid))
+    yield ents
+    return
+  for ents in purgelocs():
+    live = [ i for (i,docid) in ents if docid not in idxstomerge[i].deleted ]
+    if not live: continue
+    newest = max(live)
+    for (i,docid) in ents:
+      if i < newest:
+        idxstomerge[i].purged.add(docid)
+  # Assign new document ids from the oldest index.
+  idxorder = {}
+  ndocs = 0
+  for (i,idx) in enumerate(idxstomerge):
+    ndocs = idx.assignnewids(ndocs)
+    idxorder[idx] = len(idxstomerge)-i
   # Create a new index file.
-  maker = cdb.cdbmake(cdbname, cdbname+'.tmp')
+  maker = cdb.cdbmake(cdbname, cdbname+'.tmp', keyindex=True)
   if verbose:
     print >>sys.stderr, 'Merging: %r (docs=%d, est. terms=%d): %r' % \
           (cdbname, sum( idx.ndocs for idx in idxstomerge ),
@@ -134,19 +327,18 @@ def idxmerge(cdbname, idxstomerge, verbose=0):
   # Copy sentences to a new index file with unique ids.
   for idx in idxstomerge:
     idx.copysents(maker)
+  for idx in idxstomerge:
+    idx.copysentblocks(maker)
   # Merge document ids and offsets.
   nterms = 0
-  docid2info = []
+  nrecs = 0
   for (k,vs) in cdbmerge(idxstomerge):
-    if k[0] == PROP_LOC or k[0] == PROP_IDXINFO: break
-    if k[0] == PROP_DOCID: 
-      # read a docid->loc mapping
-      (oldid,) = unpack('>xi', k)
-      for (info,idx) in vs:
-        if oldid not in idx.old2new: continue
-        newid = idx.old2new[oldid]
-        docid2info.append((newid, info))
-        assert loc2docid[info[4:]] == newid
+    if PROP_DOCID <= k[0]: break
+    nrecs += len(vs)
+    if len(vs) == 1 and vs[0][1].offset == 0:
+      # the ids are unchanged: copy the posting without decoding.
+      maker.add(k, vs[0][0])
+      nterms += 1
     else:
       # merge docid+pos sets
       vs = sorted(( (idxorder[idx], idx.convertoldids(v)) for (v,idx) in vs ))
@@ -159,22 +351,140 @@ def idxmerge(cdbname, idxstomerge, verbose=0):
       if verbose and nterms % 1000 == 0:
         sys.stderr.write('.'); sys.stderr.flush()
 
-  # write docid->loc mappings (avoiding dupes)
-  docid2info.sort()
-  for (docid,info) in docid2info:
-    maker.add(pack('>ci', PROP_DOCID, docid), info)
-  # write loc->docid mappings (avoiding dupes)
-  for (loc,docid) in sorted(loc2docid.iteritems()):
-    if loc:
-      maker.add(PROP_LOC+loc, pack('>i', docid))
+  # write docid->loc mappings (in the ascending order of new ids)
+  for idx in idxstomerge:
+    idx.copydocids(maker)
+  # write loc->docid mappings of the live documents.
+  # (a multipart document has one mapping for each part.)
+  def convertlocs():
+    for ((k,v),i) in cdb.kmerge([ idx_iterlocs(idx.cdb) for idx in idxstomerge ]):
+      if k == PROP_LOC: continue
+      (oldid,) = unpack('>i', v)
+      newid = idxstomerge[i].docmap.get(oldid)
+      if newid:
+        yield (k, pack('>i', newid))
+    return
+  maker.addmany(convertlocs())
 
   if verbose:
-    print >>sys.stderr, 'done: docs=%d, terms=%d' % (len(docid2info), nterms)
-  maker.add(PROP_IDXINFO, pack('>ii', len(docid2info), nterms))
+    t = max(time.time() - t0, 0.001)
+    print >>sys.stderr, 'done: docs=%d, terms=%d, records=%d, time=%.1fs(%.1frecords/s)' % \
+          (ndocs, nterms, nrecs, t, nrecs/t)
+  maker.add(PROP_IDXINFO, pack('>ii', ndocs, nterms))
   maker.finish()
+  for idx in idxstomerge:
+    idx.close()
   return
 
 
+##  MergePolicy
+##
+##  A merge policy splits a list of indices (the oldest index first)
+##  into groups of adjacent indices. Each group becomes one index file.
+##
+class MergePolicy(object):
+
+  def __init__(self, max_docs_threshold=2000, max_terms_threshold=50000):
+    self.max_docs_threshold = max_docs_threshold
+    self.max_terms_threshold = max_terms_threshold
+    return
+
+  def __repr__(self):
+    return '<%s: maxdocs=%d, maxterms=%d>' % \
+           (self.__class__.__name__, self.max_docs_threshold, self.max_terms_threshold)
+
+  def select(self, idxs):
+    raise NotImplementedError
+
+
+##  LinearMergePolicy
+##
+##  Glues adjacent indices until one of the thresholds is reached.
+##  Every index that is not full yet is rewritten each time.
+##
+class LinearMergePolicy(MergePolicy):
+
+  def select(self, idxs):
+    groups = []
+    ndocs = 0
+    nterms = []
+    idxstomerge = []
+    for idx in idxs:
+      if ((self.max_docs_threshold and self.max_docs_threshold < ndocs) or
+          (self.max_terms_threshold and self.max_terms_threshold < estimate_terms(nterms))):
+        groups.append(idxstomerge)
+        idxstomerge = []
+        ndocs = 0
+        nterms = []
+      ndocs += idx.ndocs
+      nterms.append(idx.nterms)
+      idxstomerge.append(idx)
+    if idxstomerge:
+      groups.append(idxstomerge)
+    return groups
+
+
+##  TieredMergePolicy
+##
+##  Merges only adjacent indices of similar size.
+##  An index with n documents belongs to tier k when
+##  factor**k <= n < factor**(k+1), and a run of adjacent indices
+##  in the same tier is merged into one (as long as it fits in
+##  the thresholds). The merged indices are classified again,
+##  so each document is rewritten about once per tier.
+##
+class TieredMergePolicy(MergePolicy):
+
+  def __init__(self, max_docs_threshold=2000, max_terms_threshold=50000, factor=2):
+    MergePolicy.__init__(self, max_docs_threshold, max_terms_threshold)
+    assert 2 <= factor
+    self.factor = factor
+    return
+
+  def tier(self, idxs):
+    n = sum( idx.ndocs for idx in idxs )
+    k = 0
+    while self.factor <= n:
+      n /= self.factor
+      k += 1
+    return k
+
+  def fits(self, idxs):
+    if (self.max_docs_threshold and
+        self.max_docs_threshold < sum( idx.ndocs for idx in idxs )): return False
+    if (self.max_terms_threshold and
+        self.max_terms_threshold < estimate_terms( idx.nterms for idx in idxs )): return False
+    return True
+
+  def select(self, idxs):
+    groups = [ [idx] for idx in idxs ]
+    merged = True
+    while merged:
+      merged = False
+      i = 0
+      while i < len(groups):
+        k = self.tier(groups[i])
+        run = groups[i]
+        j = i+1
+        while (j < len(groups) and self.tier(groups[j]) == k and
+               self.fits(run+groups[j])):
+          run = run+groups[j]
+          j += 1
+        if i+1 < j:
+          groups[i:j] = [run]
+          merged = True
+        i += 1
+    return groups
+
+
+# Worker process for parallel merging.
+# Each worker reopens the segments by itself and only writes
+# the new index file (*.new); the renames are done by the parent.
+def _worker_merge((cdbname, fnames, verbose)):
+  idxmerge(cdbname, [ IndexFile(fname) for fname in fnames ], verbose)
+  return cdbname
+
+
 ##  Merger
 ##
 class Merger(object):
@@ -182,11 +492,18 @@ class Merger(object):
   def __init__(self, indexdb,
                max_docs_threshold=2000,
                max_terms_threshold=50000,
-               verbose=0):
+               verbose=0, nworkers=1, policy=None):
     self.indexdb = indexdb
     self.max_docs_threshold = max_docs_threshold
     self.max_terms_threshold = max_terms_threshold
     self.verbose = verbose
+    self.nworkers = nworkers
+    if policy == None:
+      policy = TieredMergePolicy(max_docs_threshold, max_terms_threshold)
+    self.policy = policy
+    # statistics of the last run.
+    self.rewritten = 0
+    self.nsegments = 0
     return
 
   def flush(self, idxid, idxstomerge):
@@ -194,39 +511,89 @@ class Merger(object):
     fname = self.indexdb.gen_idx_fname(idxid)
     if 1 < len(idxstomerge):
       idxmerge(fname+'.new', idxstomerge, self.verbose)
+    self.install(idxid, idxstomerge)
+    return
+
+  # Replaces the merged indices with the new one (fname.new).
+  def install(self, idxid, idxstomerge):
+    if not idxstomerge: return
+    fname = self.indexdb.gen_idx_fname(idxid)
+    if 1 < len(idxstomerge):
       for idx in idxstomerge:
         idx.close()
         os.rename(idx.fname, idx.fname+'.bak')
+        if os.path.exists(idx.deleted.path):
+          os.unlink(idx.deleted.path)
       os.rename(fname+'.new', fname)
     elif idxstomerge[0].fname == fname:
       if self.verbose:
         print >>sys.stderr, 'Remain: %r' % (fname)
     else:
       os.rename(idxstomerge[0].fname, fname)
+      if os.path.exists(idxstomerge[0].deleted.path):
+        os.rename(idxstomerge[0].deleted.path, DocBitmap.get_path(fname))
       if self.verbose:
         print >>sys.stderr, 'Rename: %r <- %r' % (fname, idxstomerge[0].fname)
+    # the cached readers now point to the old files.
+    IndexDB.forget_idx(fname)
+    for idx in idxstomerge:
+      IndexDB.forget_idx(idx.fname)
     return
 
-  def run(self, cleanup=False):
+  # Splits the indices into groups to merge.
+  def get_groups(self):
     # idxs: a list of indices (the oldest index comes first).
     idxs = [ IndexFile(os.path.join(self.indexdb.idxdir, fname)) for fname in reversed(self.indexdb.idxs) ]
-    ndocs = 0
-    nterms = []
-    newidx = 0
-    idxstomerge = []
+    # only the number of documents and terms are read here.
     for idx in idxs:
       idx.open()
-      if ((self.max_docs_threshold and self.max_docs_threshold < ndocs) or
-          (self.max_terms_threshold and self.max_terms_threshold < estimate_terms(nterms))):
-        self.flush(newidx, idxstomerge)
-        newidx += 1
-        idxstomerge = []
-        ndocs = 0
-        nterms = []
-      ndocs += idx.ndocs
-      nterms.append(idx.nterms)
-      idxstomerge.append(idx)
-    self.flush(newidx, idxstomerge)
+      idx.close()
+    return self.policy.select(idxs)
+
+  # Merges the groups with nworkers processes.
+  # The groups never share an index file, so they can be merged
+  # independently. The renames are done after all the merges
+  # succeed; otherwise the index files are left untouched.
+  def merge_groups(self, groups):
+    from multiprocessing import Pool
+    jobs = [ (self.indexdb.gen_idx_fname(idxid)+'.new',
+              [ idx.fname for idx in idxstomerge ], self.verbose)
+             for (idxid,idxstomerge) in enumerate(groups) if 1 < len(idxstomerge) ]
+    pool = Pool(min(self.nworkers, max(len(jobs), 1)))
+    try:
+      try:
+        for cdbname in pool.imap_unordered(_worker_merge, jobs):
+          if 2 <= self.verbose:
+            print >>sys.stderr, 'Merged: %r' % cdbname
+        pool.close()
+      finally:
+        pool.terminate()
+        pool.join()
+    except:
+      for (cdbname,_,_) in jobs:
+        for fname in (cdbname, cdbname+'.tmp'):
+          if os.path.exists(fname):
+            os.unlink(fname)
+      raise
+    for (idxid,idxstomerge) in enumerate(groups):
+      self.install(idxid, idxstomerge)
+    return
+
+  def run(self, cleanup=False):
+    groups = self.get_groups()
+    if 1 < self.nworkers and 1 < sum( 1 for idxs in groups if 1 < len(idxs) ):
+      self.merge_groups(groups)
+    else:
+      for (idxid,idxstomerge) in enumerate(groups):
+        self.flush(idxid, idxstomerge)
+    # bytes written to the new index files.
+    self.rewritten = sum( os.path.getsize(self.indexdb.gen_idx_fname(idxid))
+                          for (idxid,idxstomerge) in enumerate(groups)
+                          if 1 < len(idxstomerge) )
+    self.nsegments = len(groups)
+    if self.verbose:
+      print >>sys.stderr, 'Policy: %r, segments: %d -> %d, rewritten: %d bytes' % \
+            (self.policy, sum( len(idxs) for idxs in groups ), self.nsegments, self.rewritten)
     if cleanup:
       for fname in os.listdir(self.indexdb.idxdir):
         if fname.endswith('.cdb.bak'):
@@ -235,4 +602,5 @@ class Merger(object):
             print >>sys.stderr, 'Removing: %r' % fname
           os.unlink(fname)
     self.indexdb.refresh()
+    self.indexdb.update_locidx()
     return
@@ -6,14 +6,22 @@
 #   * public domain *
 # 
 
-import sys, os
-from struct import pack, unpack
+import sys, os, mmap
+from struct import pack, unpack, unpack_from
 from array import array
+from bisect import bisect_left
+from heapq import heapify, heapreplace, heappop
 
 
 # calc hash value with a given key
-def cdbhash(s, n=5381L):
-  return reduce(lambda h,c: ((h*33) ^ ord(c)) & 0xffffffffL, s, n)
+#   (same as reduce(lambda h,c: ((h*33) ^ ord(c)) & 0xffffffff, s, n))
+def cdbhash(s, n=5381):
+  h = n
+  for c in bytearray(s):
+    h = ((h*33) ^ c) & 0xffffffff
+  return h
+# (Hashing many keys in one call, even reusing the hash of the prefix
+#  shared with the previous key, is not faster than this in Python.)
 
 if pack('=i',1) == pack('>i',1):
   # big endian
@@ -36,6 +44,40 @@ else:
 ##  CDB
 ##
 
+# Large file format (64-bit offsets):
+#   A normal cdb file begins with the position of the first hash
+#   table, which is never 0xffffffff. A large file begins with
+#   0xffffffff, LARGEFILE_VERSION and the position of the bucket table
+#   (uint64 * 512), which is placed right after the hash tables.
+#   Each hash cell is a pair of uint64. The records are stored in
+#   the same way in both formats, starting at the offset 2048.
+LARGEFILE_MARK = 0xffffffffL
+LARGEFILE_VERSION = 'CD64'
+
+# Returns an array that can hold 64-bit file offsets.
+if array('L').itemsize == 8:
+  def offsetarray():
+    return array('L')
+else:
+  def offsetarray():
+    return []
+
+# Key index: an optional trailer after the hash tables.
+#   positions (uint32 * n) + nkeys + stride + KEYINDEX_MAGIC
+# stride == 1: the positions of all the records in the key order.
+# stride > 1: the records are sorted in the file and every stride-th
+#   record position is sampled.
+KEYINDEX_MAGIC = 'KIDX'
+KEYINDEX_STRIDE = 64
+
+# Returns the smallest string that is greater than all the strings
+# beginning with the prefix. (None if there is no such string.)
+def prefixend(prefix):
+  prefix = prefix.rstrip('\xff')
+  if not prefix: return None
+  return prefix[:-1]+chr(ord(prefix[-1])+1)
+
+
 # cdbiter
 def cdbiter(fp, eod):
   kloc = fp.tell()
@@ -49,6 +91,44 @@ def cdbiter(fp, eod):
   fp.close()
   return
 
+# cdbscan: reads the records from kloc to eod in large chunks.
+#   If types is given, only the records whose key begins with
+#   one of the bytes in types are returned.
+SCANBUFSIZE = 1024*1024
+def cdbscan(fp, kloc, eod, types=None, bufsize=SCANBUFSIZE):
+  if types != None:
+    types = frozenset(types)
+  buf = ''
+  while kloc < eod:
+    # read the next chunk (aligned to bufsize).
+    fp.seek(kloc)
+    data = fp.read(min(bufsize - kloc % bufsize, eod-kloc))
+    if not data: raise EOFError(kloc)
+    kloc += len(data)
+    buf += data
+    (i, n) = (0, len(buf))
+    while i+8 <= n:
+      (klen, vlen) = unpack_from('<II', buf, i)
+      j = i+8+klen
+      if n < j+vlen: break
+      if types == None or buf[i+8:i+9] in types:
+        yield (buf[i+8:j], buf[j:j+vlen])
+      i = j+vlen
+    buf = buf[i:]
+  return
+
+# mmapiter
+def mmapiter(m, kloc, eod, types=None):
+  if types != None:
+    types = frozenset(types)
+  while kloc < eod:
+    (klen, vlen) = unpack_from('<II', m, kloc)
+    kloc += 8
+    if types == None or m[kloc:kloc+1] in types:
+      yield (m[kloc:kloc+klen], m[kloc+klen:kloc+klen+vlen])
+    kloc += klen+vlen
+  return
+
 
 # CDBReader
 class CDBReader(object):
@@ -56,12 +136,48 @@ class CDBReader(object):
   def __init__(self, cdbname):
     self.name = cdbname
     self._fp = file(cdbname, 'rb')
-    hash0 = decode(self._fp.read(2048))
-    self._hash0 = [ (hash0[i], hash0[i+1]) for i in xrange(0, 512, 2) ]
+    st = os.fstat(self._fp.fileno())
+    self._size = st.st_size
+    # identifies the file even if it is replaced later.
+    self.fileid = (st.st_ino, st.st_mtime)
+    self._readheader()
     self._hash1 = [ None ] * 256
+    return
+
+  # (Internal) Reads the bucket table and detects the file format.
+  def _readheader(self):
+    hash0 = decode(self._read(0, 2048))
+    self._large = (hash0[0] == LARGEFILE_MARK)
+    if self._large:
+      (_, version, pos_table) = unpack('<I4sQ', self._read(0, 16))
+      if version != LARGEFILE_VERSION:
+        raise ValueError('unsupported format: %r' % version)
+      hash0 = unpack('<512Q', self._read(pos_table, 4096))
+      self._cellsize = 16
+      self._pos_index = pos_table+4096
+    else:
+      self._cellsize = 8
+    self._hash0 = [ (hash0[i], hash0[i+1]) for i in xrange(0, 512, 2) ]
     (self._eod,_) = self._hash0[0]
+    if not self._large:
+      self._pos_index = self._eod + sum( ncells for (_,ncells) in self._hash0 )*8
+    self._keyidx = None
+    self._positions = None
     return
 
+  # (Internal) Returns the hash table of a bucket: [h0,p0, h1,p1, ...]
+  def _cells(self, h1):
+    hs = self._hash1[h1]
+    if hs == None:
+      (pos_bucket, ncells) = self._hash0[h1]
+      data = self._read(pos_bucket, ncells*self._cellsize)
+      if self._large:
+        hs = unpack('<%dQ' % (ncells*2), data)
+      else:
+        hs = decode(data)
+      self._hash1[h1] = hs
+    return hs
+
   def __repr__(self):
     return '<CDBReader: %r>' % self.name
 
@@ -77,11 +193,7 @@ class CDBReader(object):
     h1 = h & 0xff
     (pos_bucket, ncells) = self._hash0[h1]
     if ncells == 0: raise KeyError(k)
-    hs = self._hash1[h1]
-    if hs == None:
-      self._fp.seek(pos_bucket)
-      hs = decode(self._fp.read(ncells * 8))
-      self._hash1[h1] = hs
+    hs = self._cells(h1)
     i = ((h >> 8) % ncells) * 2
     n = ncells*2
     for _ in xrange(ncells):
@@ -118,39 +230,299 @@ class CDBReader(object):
   def __contains__(self, k):
     return self.has_key(k)
 
-  def iterkeys(self, startkey=None):
-    if startkey != None:
-      self[startkey]
-      self._fp.seek(self._lastpos)
+  # Returns all the values of the key (in the order of addition).
+  def getall(self, k):
+    k = str(k)
+    r = []
+    for p1 in sorted(self._probe(cdbhash(k))):
+      (k1, v1) = self._record(p1)
+      if k1 == k:
+        r.append(v1)
+    return r
+
+  # (Internal) Returns the positions of the records whose hash is h,
+  # in the probing order.
+  def _probe(self, h):
+    h1 = h & 0xff
+    (pos_bucket, ncells) = self._hash0[h1]
+    if ncells == 0: return []
+    hs = self._cells(h1)
+    r = []
+    i = ((h >> 8) % ncells) * 2
+    n = ncells*2
+    for _ in xrange(ncells):
+      p1 = hs[i+1]
+      if p1 == 0: break
+      if hs[i] == h:
+        r.append(p1)
+      i = (i+2) % n
+    return r
+
+  # (Internal) Returns n bytes at the position.
+  def _read(self, pos, n):
+    self._fp.seek(pos)
+    return self._fp.read(n)
+
+  # (Internal) Returns the (key, value) of the record at the position.
+  def _record(self, pos):
+    self._fp.seek(pos)
+    (klen, vlen) = unpack('<II', self._fp.read(8))
+    return (self._fp.read(klen), self._fp.read(vlen))
+
+  # (Internal) Returns the key of the record at the position.
+  def _key(self, pos):
+    self._fp.seek(pos)
+    (klen, _) = unpack('<II', self._fp.read(8))
+    return self._fp.read(klen)
+
+  # (Internal) Iterates the records from the position to the end.
+  def _scan(self, pos, types=None):
+    return cdbscan(self._fp, pos, self._eod, types)
+
+  # (Internal) Returns (positions, stride) of the key index.
+  # If the file does not have one, positions is empty.
+  def _getkeyindex(self):
+    if self._keyidx == None:
+      self._keyidx = ((), KEYINDEX_STRIDE)
+      pos_index = self._pos_index
+      if pos_index+12 <= self._size:
+        (nkeys, stride, magic) = unpack('<II4s', self._read(self._size-12, 12))
+        size = nkeys*self._cellsize/2
+        if magic == KEYINDEX_MAGIC and pos_index+size+12 == self._size:
+          data = self._read(pos_index, size)
+          if self._large:
+            self._keyidx = (unpack('<%dQ' % nkeys, data), stride)
+          else:
+            self._keyidx = (decode(data), stride)
+    return self._keyidx
+
+  # (Internal) Returns the positions of all the records in the file order.
+  # They are taken from the hash tables, so that a file without the key
+  # index can be searched as if it had a full one.
+  def _recordpositions(self):
+    if self._positions == None:
+      r = []
+      for (pos_bucket, ncells) in self._hash0:
+        if ncells == 0: continue
+        data = self._read(pos_bucket, ncells*self._cellsize)
+        if self._large:
+          hs = unpack('<%dQ' % (ncells*2), data)
+        else:
+          hs = decode(data)
+        r.extend(hs[1::2])
+      # empty cells have position 0.
+      r.sort()
+      self._positions = r[bisect_left(r, 1):]
+    return self._positions
+
+  # Returns True if the file has the key index.
+  def haskeyindex(self):
+    (positions, _) = self._getkeyindex()
+    return bool(positions)
+
+  # Iterates (key, value) pairs such that startkey <= key < endkey
+  # in the key order. Without the key index, the records are assumed
+  # to be sorted in the file and all the record positions are used.
+  def iterrange(self, startkey='', endkey=None):
+    (positions, stride) = self._getkeyindex()
+    if not positions:
+      (positions, stride) = (self._recordpositions(), 1)
+    # find the first i such that startkey <= key(positions[i]).
+    (i0, i1) = (0, len(positions))
+    while i0 < i1:
+      i = (i0+i1)//2
+      if self._key(positions[i]) < startkey:
+        i0 = i+1
+      else:
+        i1 = i
+    if stride == 1:
+      for i in xrange(i0, len(positions)):
+        (k,v) = self._record(positions[i])
+        if endkey != None and endkey <= k: break
+        yield (k,v)
     else:
-      self._fp.seek(2048)
-    return ( k for (k,v) in cdbiter(self._fp, self._eod) )
+      if i0:
+        pos = positions[i0-1]
+      else:
+        pos = 2048
+      for (k,v) in self._scan(pos):
+        if k < startkey: continue
+        if endkey != None and endkey <= k: break
+        yield (k,v)
+    return
+
+  # Iterates (key, value) pairs whose key begins with the prefix.
+  def iterprefix(self, prefix):
+    return self.iterrange(prefix, prefixend(prefix))
+
+  # Looks up multiple keys at once and returns a list of their values.
+  # A missing key gets the "default" value. The keys are hashed once,
+  # the hash tables are visited bucket by bucket, and the records are
+  # read in the order of their file offsets.
+  def get_many(self, keys, default=None):
+    keys = [ str(k) for k in keys ]
+    hs = [ cdbhash(k) for k in keys ]
+    cands = []
+    for i in sorted(xrange(len(keys)), key=lambda i: hs[i] & 0xff):
+      for (rank,p1) in enumerate(self._probe(hs[i])):
+        cands.append((p1, rank, i))
+    cands.sort()
+    r = [ default ] * len(keys)
+    found = {}
+    (pos, rec) = (None, None)
+    for (p1, rank, i) in cands:
+      if i in found and found[i] < rank: continue
+      if p1 != pos:
+        (pos, rec) = (p1, self._record(p1))
+      (k, v) = rec
+      if k == keys[i]:
+        r[i] = v
+        found[i] = rank
+    return r
+
+  def iterkeys(self, startkey=None):
+    return ( k for (k,v) in self.iteritems(startkey) )
   def itervalues(self, startkey=None):
-    if startkey != None:
-      self[startkey]
-      self._fp.seek(self._lastpos)
-    else:
-      self._fp.seek(2048)
-    return ( v for (k,v) in cdbiter(self._fp, self._eod) )
+    return ( v for (k,v) in self.iteritems(startkey) )
   def iteritems(self, startkey=None):
+    return self.scan(startkey=startkey)
+
+  # Iterates all the records in the file order (from startkey if given).
+  # If types is given, only the keys that begin with one of its bytes
+  # are returned, e.g. scan(PROP_SENT).
+  def scan(self, types=None, startkey=None):
     if startkey != None:
       self[startkey]
-      self._fp.seek(self._lastpos)
+      return self._scan(self._lastpos, types)
     else:
-      self._fp.seek(2048)
-    return cdbiter(self._fp, self._eod)
+      return self._scan(2048, types)
+
+
+# CDBMMapReader
+#   Maps the whole cdb file into memory and slices the header,
+#   hash cells and records straight from the mapping. A lookup costs
+#   no system call and the pages are shared among all the processes
+#   that open the same file.
+class CDBMMapReader(CDBReader):
+
+  def __init__(self, cdbname):
+    self.name = cdbname
+    fp = file(cdbname, 'rb')
+    try:
+      st = os.fstat(fp.fileno())
+      self.fileid = (st.st_ino, st.st_mtime)
+      self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+      fp.close()
+    self._size = len(self._map)
+    self._readheader()
+    if self._large:
+      self._cellfmt = '<QQ'
+    else:
+      self._cellfmt = '<II'
+    return
+
+  def __repr__(self):
+    return '<CDBMMapReader: %r>' % self.name
+
+  def __getitem__(self, k):
+    k = str(k)
+    h = cdbhash(k)
+    (pos_bucket, ncells) = self._hash0[h & 0xff]
+    if ncells == 0: raise KeyError(k)
+    m = self._map
+    (cellfmt, cellsize) = (self._cellfmt, self._cellsize)
+    i = (h >> 8) % ncells
+    for _ in xrange(ncells):
+      (h1, p1) = unpack_from(cellfmt, m, pos_bucket + i*cellsize)
+      if p1 == 0: raise KeyError(k)
+      if h1 == h:
+        (klen, vlen) = unpack_from('<II', m, p1)
+        p = p1+8
+        if m[p:p+klen] == k:
+          self._lastpos = p1
+          p += klen
+          return m[p:p+vlen]
+      i = (i+1) % ncells
+    raise KeyError(k)
+
+  def close(self):
+    self._map.close()
+    return
+
+  def _probe(self, h):
+    (pos_bucket, ncells) = self._hash0[h & 0xff]
+    if ncells == 0: return []
+    m = self._map
+    (cellfmt, cellsize) = (self._cellfmt, self._cellsize)
+    r = []
+    i = (h >> 8) % ncells
+    for _ in xrange(ncells):
+      (h1, p1) = unpack_from(cellfmt, m, pos_bucket + i*cellsize)
+      if p1 == 0: break
+      if h1 == h:
+        r.append(p1)
+      i = (i+1) % ncells
+    return r
+
+  def _read(self, pos, n):
+    return self._map[pos:pos+n]
+
+  def _record(self, pos):
+    m = self._map
+    (klen, vlen) = unpack_from('<II', m, pos)
+    pos += 8
+    return (m[pos:pos+klen], m[pos+klen:pos+klen+vlen])
+
+  def _key(self, pos):
+    (klen, _) = unpack_from('<II', self._map, pos)
+    return self._map[pos+8:pos+8+klen]
+
+  def _scan(self, pos, types=None):
+    return mmapiter(self._map, pos, self._eod, types)
+
+
+# cdbtable: builds an open-addressed hash table of a bucket.
+#   b1 = [h0,p0, h1,p1, ...] -> [h,p, h,p, ...] (len(b1) cells)
+def cdbtable(b1):
+  ncells = len(b1)
+  n = ncells*2
+  a = [0]*n
+  for (h,p) in zip(b1[0::2], b1[1::2]):
+    i = ((h >> 8) % ncells)*2
+    while a[i+1]:               # is cell[i] already occupied?
+      i += 2
+      if i == n: i = 0
+    a[i] = h
+    a[i+1] = p
+  return a
 
 
 # CDBMaker
 class CDBMaker(object):
 
-  def __init__(self, cdbname, tmpname):
+  # Switches to the large file format if needed.
+  LARGEFILE = True
+  # Size of the write buffer.
+  BUFSIZE = 1024*1024
+
+  def __init__(self, cdbname, tmpname, keyindex=False, large=False):
     self.fn = cdbname
     self.fntmp = tmpname
     self.numentries = 0
-    self._fp = file(tmpname, 'wb')
+    self._fp = file(tmpname, 'w+b')
     self._pos = 2048                    # sizeof((h,p))*256
-    self._bucket = [ array('I') for _ in xrange(256) ]
+    self._fp.seek(self._pos)
+    self._buf = []
+    self._bufsize = 0
+    self._bucket = [ offsetarray() for _ in xrange(256) ]
+    self._large = large
+    # positions of all the records (for the key index).
+    self._keyidx = None
+    if keyindex:
+      self._keyidx = offsetarray()
+    self._lastkey = ''
+    self._sorted = True
     return
 
   def __repr__(self):
@@ -165,46 +537,111 @@ class CDBMaker(object):
   def __setstate__(self, dict):
     raise TypeError
 
+  # (Internal) Appends a record to the write buffer and returns its position.
+  def _write(self, k, v):
+    (klen, vlen) = (len(k), len(v))
+    pos = self._pos
+    self._buf.append(pack('<II', klen, vlen))
+    self._buf.append(k)
+    self._buf.append(v)
+    # sizeof(keylen)+sizeof(datalen)+sizeof(key)+sizeof(data)
+    self._pos += 8+klen+vlen
+    self._bufsize += 8+klen+vlen
+    if self.BUFSIZE <= self._bufsize:
+      self._flushbuf()
+    return pos
+
+  # (Internal) Writes out the buffered records.
+  def _flushbuf(self):
+    self._fp.write(''.join(self._buf))
+    self._buf = []
+    self._bufsize = 0
+    return
+
   def add(self, k, v):
     (k, v) = (str(k), str(v))
-    (klen, vlen) = (len(k), len(v))
-    self._fp.seek(self._pos)
-    self._fp.write(pack('<II', klen, vlen))
-    self._fp.write(k)
-    self._fp.write(v)
-    h = cdbhash(k)
+    return self._add(k, v, cdbhash(k))
+
+  # Adds a sequence of (key, value) pairs.
+  def addmany(self, items):
+    for (k,v) in items:
+      (k, v) = (str(k), str(v))
+      self._add(k, v, cdbhash(k))
+    return self
+
+  # (Internal)
+  def _add(self, k, v, h):
+    pos = self._write(k, v)
     b = self._bucket[h % 256]
     b.append(h)
-    b.append(self._pos)
-    # sizeof(keylen)+sizeof(datalen)+sizeof(key)+sizeof(data)
-    self._pos += 8+klen+vlen
+    b.append(pos)
+    if self._keyidx != None:
+      self._keyidx.append(pos)
+      if k < self._lastkey:
+        self._sorted = False
+      self._lastkey = k
     self.numentries += 1
     return self
+
+  # (Internal) Encodes a list of integers as uint32 or uint64.
+  def _encode(self, a, large):
+    if large:
+      return pack('<%dQ' % len(a), *a)
+    else:
+      return encode(array('I', a))
+
+  # (Internal) Returns the key index that is appended after the hash tables.
+  def _keyindex_data(self, large):
+    if self._sorted:
+      stride = KEYINDEX_STRIDE
+      a = self._keyidx[::stride]
+    else:
+      # the records are not in order: sort all the positions by their keys.
+      stride = 1
+      def getkey(pos):
+        self._fp.seek(pos)
+        (klen, _) = unpack('<II', self._fp.read(8))
+        return self._fp.read(klen)
+      a = sorted(self._keyidx, key=getkey)
+    return self._encode(a, large) + pack('<II4s', len(a), stride, KEYINDEX_MAGIC)
   
   def finish(self):
-    self._fp.seek(self._pos)
+    self._flushbuf()
     pos_hash = self._pos
+    # use the large file format if the hash tables go beyond 4GB.
+    large = self._large or (0xffffffffL < pos_hash + sum( len(b1) for b1 in self._bucket )*8)
+    if large and not self.LARGEFILE:
+      raise OverflowError('file too large: %r' % self.fn)
     # write hashes
     for b1 in self._bucket:
       if not b1: continue
-      blen = len(b1)
-      a = array('I', [0]*blen*2)
-      for j in xrange(0, blen, 2):
-        (h,p) = (b1[j],b1[j+1])
-        i = ((h >> 8) % blen)*2
-        while a[i+1]:             # is cell[i] already occupied?
-          i = (i+2) % len(a)
-        a[i] = h
-        a[i+1] = p
-      self._fp.write(encode(a))
-    # write header
-    self._fp.seek(0)
-    a = array('I')
+      self._buf.append(self._encode(cdbtable(b1), large))
+      self._bufsize += len(self._buf[-1])
+      if self.BUFSIZE <= self._bufsize:
+        self._flushbuf()
+    # write bucket table
+    a = []
     for b1 in self._bucket:
       a.append(pos_hash)
       a.append(len(b1))
-      pos_hash += len(b1)*8
-    self._fp.write(encode(a))
+      if large:
+        pos_hash += len(b1)*16
+      else:
+        pos_hash += len(b1)*8
+    if large:
+      self._buf.append(self._encode(a, large))
+    self._flushbuf()
+    # write key index
+    if self._keyidx != None:
+      data = self._keyindex_data(large)
+      self._fp.seek(0, 2)
+      self._fp.write(data)
+    # write header
+    self._fp.seek(0)
+    if large:
+      self._fp.write(pack('<I4sQ', LARGEFILE_MARK, LARGEFILE_VERSION, pos_hash))
+    else:
+      self._fp.write(self._encode(a, large))
     # close
     self._fp.close()
     os.rename(self.fntmp, self.fn)
@@ -229,42 +666,49 @@ class CDBMaker(object):
 
 
 # cdbdump
-def cdbdump(cdbname):
-  fp = file(cdbname, 'rb')
-  (eor,) = unpack('<I', fp.read(4))
-  fp.seek(2048)
-  return cdbiter(fp, eor)
+def cdbdump(cdbname, types=None):
+  return CDBReader(cdbname).scan(types)
 
 
 # cdbmerge
 def cdbmerge(iters):
-  q = []
-  for it in iters:
-    try:
-      q.append((it.next(),it))
-    except StopIteration:
-      pass
   k0 = None
   vs = None
-  while q:
-    q.sort()
-    ((k,v),it) = q.pop(0)
+  for ((k,v),_) in kmerge(iters):
     if k0 != k:
       if vs: yield (k0,vs)
       vs = []
     vs.append(v)
     k0 = k
+  if vs: yield (k0,vs)
+  return
+
+# kmerge: merges sorted streams of (key,value) with a heap.
+#   Each stream is an object with next() (e.g. a generator).
+#   Yields ((key,value), i) in order, where i is the index of the stream.
+#   Ties are broken by the stream order.
+def kmerge(iters):
+  q = []
+  for (i,it) in enumerate(iters):
     try:
-      q.append((it.next(),it))
+      q.append((it.next(), i, it.next))
     except StopIteration:
-      continue
-  if vs: yield (k0,vs)
+      pass
+  heapify(q)
+  while q:
+    (x, i, next) = q[0]
+    yield (x, i)
+    try:
+      heapreplace(q, (next(), i, next))
+    except StopIteration:
+      heappop(q)
   return
 
 
 # aliases
 cdbmake = CDBMaker
 init = CDBReader
+mmapinit = CDBMMapReader
 
 
 ##  TCDB
@@ -304,6 +748,9 @@ def tcdbiter(fp, eor):
 # TCDBMaker
 class TCDBMaker(CDBMaker):
 
+  # tcdbiter and TCDBReader do not support the large file format.
+  LARGEFILE = False
+
   def __init__(self, cdbname, tmpname):
     CDBMaker.__init__(self, cdbname, tmpname)
     self._parent = 0
@@ -319,14 +766,7 @@ class TCDBMaker(CDBMaker):
       raise ValueError('invalid depth: %d' % depth)
     #
     (k, v) = (str(k), str(v))
-    (klen, vlen) = (len(k), len(v))
-    self._parent = self._pos
-    # sizeof(keylen)+sizeof(datalen)+sizeof(key)+sizeof(data)
-    self._fp.seek(self._pos)
-    self._fp.write(pack('<II', klen, vlen))
-    self._fp.write(k)
-    self._fp.write(v)
-    self._pos += 4+4+klen+vlen
+    self._parent = self._write(k, v)
     h = cdbhash(k, self._stack[-1]+5381L)
     b = self._bucket[h % 256]
     b.append(h)
@@ -396,22 +836,340 @@ def tcdbdump(cdbname):
   return tcdbiter(fp, eor)
 
 
+# TCDBTrie
+#   An in-memory version of TCDBReader.
+#   Nodes are numbered in breadth-first order (0 is the root) and
+#   the children of node n are the nodes first[n]...first[n+1]-1,
+#   sorted by their keys. lookup1() returns a node number instead of
+#   a file position, which is passed as a parent to the next call.
+#   The arrays are cached in a file (cdbname+'.trie' by default).
+class TCDBTrie(object):
+
+  VERSION = 1
+
+  def __init__(self, cdbname, cachename=None):
+    self.name = cdbname
+    if cachename == None:
+      cachename = cdbname+'.trie'
+    st = os.stat(cdbname)
+    # the cache is valid only for the same source size and mtime.
+    stamp = (self.VERSION, st.st_size, st.st_mtime)
+    if not self._load(cachename, stamp):
+      self._build(cdbname)
+      self._save(cachename, stamp)
+    return
+
+  def __repr__(self):
+    return '<TCDBTrie: %r, %d nodes>' % (self.name, len(self._keys))
+
+  # (Internal) Reads the cache file if it is up to date.
+  def _load(self, cachename, stamp):
+    import marshal
+    try:
+      fp = file(cachename, 'rb')
+    except IOError:
+      return False
+    try:
+      try:
+        (stamp1, first, keys, values) = marshal.load(fp)
+      except (EOFError, ValueError, TypeError):
+        return False
+    finally:
+      fp.close()
+    if stamp1 != stamp:
+      return False
+    self._first = array('I', first)
+    (self._keys, self._values) = (keys, values)
+    return True
+
+  # (Internal) Writes the cache file. Errors are ignored.
+  def _save(self, cachename, stamp):
+    import marshal
+    tmpname = cachename+'.tmp'
+    try:
+      fp = file(tmpname, 'wb')
+      try:
+        marshal.dump((stamp, self._first.tostring(), self._keys, self._values), fp)
+      finally:
+        fp.close()
+      os.rename(tmpname, cachename)
+    except (IOError, OSError):
+      pass
+    return
+
+  # (Internal) Builds the arrays from a tcdb file.
+  def _build(self, cdbname):
+    # construct a tree: node = [value, {key: node}]
+    root = [None, {}]
+    path = [root]
+    for (key, v) in tcdbdump(cdbname):
+      del path[len(key):]
+      node = [v, {}]
+      path[-1][1][key[-1]] = node
+      path.append(node)
+    # number the nodes in breadth-first order.
+    self._first = array('I')
+    (self._keys, self._values) = ([''], [''])
+    queue = [root]
+    for (_,children) in queue:
+      self._first.append(len(self._keys))
+      for k in sorted(children.iterkeys()):
+        node = children[k]
+        self._keys.append(k)
+        self._values.append(node[0])
+        queue.append(node)
+    self._first.append(len(self._keys))
+    return
+
+  def lookup(self, seq, parent=0):
+    r = []
+    for k in seq:
+      (v, parent) = self.lookup1(k, parent)
+      r.append(v)
+    return r
+
+  def lookup1(self, k, parent=0):
+    (lo, hi) = (self._first[parent], self._first[parent+1])
+    i = bisect_left(self._keys, k, lo, hi)
+    if i < hi and self._keys[i] == k:
+      return (self._values[i], i)
+    raise KeyError(k)
+
+  def close(self):
+    return
+
+
 # aliases
 tcdbmake = TCDBMaker
 tcdbinit = TCDBReader
+tcdbtrie = TCDBTrie
 tcdbmerge = cdbmerge
 
 
+# test
+def test(argv):
+  import unittest
+  dirname = './test_pycdb/'
+
+  class TestCDB(unittest.TestCase):
+
+    def setUp(self):
+      os.mkdir(dirname)
+      self.path = os.path.join(dirname, 'test.cdb')
+      self.data = [ ('key%d' % i, 'value%d' % (i*i)) for i in xrange(1000) ]
+      maker = CDBMaker(self.path, self.path+'.tmp')
+      for (k,v) in self.data:
+        maker.add(k, v)
+      maker.finish()
+      return
+
+    def tearDown(self):
+      for fname in os.listdir(dirname):
+        os.unlink(os.path.join(dirname, fname))
+      os.rmdir(dirname)
+      return
+
+    def assertReader(self, reader):
+      db = reader(self.path)
+      for (k,v) in self.data:
+        self.assertEqual(db[k], v)
+        self.assertTrue(db.has_key(k))
+      self.assertRaises(KeyError, lambda: db['nokey'])
+      self.assertEqual(db.get('nokey'), None)
+      self.assertEqual(list(db.iteritems()), self.data)
+      self.assertEqual(list(db.iterkeys(startkey='key990')),
+                       [ k for (k,v) in self.data[990:] ])
+      # lookups in the middle of a scan.
+      r = []
+      for (k,v) in db.scan():
+        self.assertEqual(db[k], v)
+        r.append((k,v))
+      self.assertEqual(r, self.data)
+      self.assertEqual(list(db.scan('x')), [])
+      self.assertEqual(list(db.scan('k', startkey='key998')), self.data[998:])
+      return
+
+    def test_cdbscan(self):
+      path = os.path.join(dirname, 'scan.cdb')
+      data = [ ('%c%d' % ('abc'[i%3], i), 'x'*(i*7)) for i in xrange(100) ]
+      maker = CDBMaker(path, path+'.tmp')
+      maker.addmany(data)
+      maker.finish()
+      db = CDBReader(path)
+      for bufsize in (1, 16, 100, 4096):
+        fp = file(path, 'rb')
+        self.assertEqual(list(cdbscan(fp, 2048, db._eod, bufsize=bufsize)), data)
+        self.assertEqual(list(cdbscan(fp, 2048, db._eod, 'ab', bufsize=bufsize)),
+                         [ (k,v) for (k,v) in data if k[0] != 'c' ])
+        fp.close()
+      self.assertEqual(list(cdbdump(path, 'c')), data[2::3])
+      return
+
+    def test_cdbhash(self):
+      def cdbhash0(s, n=5381L):
+        return reduce(lambda h,c: ((h*33) ^ ord(c)) & 0xffffffffL, s, n)
+      keys = [ k for (k,_) in self.data ] + \
+             [ '', '\x00', '\xff'*100, ''.join(map(chr, xrange(256))) ]
+      for k in keys:
+        self.assertEqual(cdbhash(k), cdbhash0(k))
+        self.assertEqual(cdbhash(k, 123456789L+5381L), cdbhash0(k, 123456789L+5381L))
+      return
+
+    def test_reader(self):
+      self.assertReader(CDBReader)
+      return
+
+    def test_mmapreader(self):
+      self.assertReader(CDBMMapReader)
+      return
+
+    def assertGetMany(self, reader):
+      db = reader(self.path)
+      keys = ['key5', 'nokey', 'key999', 'key5', 'key0']
+      self.assertEqual(db.get_many(keys),
+                       ['value25', None, 'value998001', 'value25', 'value0'])
+      self.assertEqual(db.get_many([]), [])
+      self.assertEqual(db.get_many(['nokey'], default=''), [''])
+      return
+
+    def test_get_many(self):
+      self.assertGetMany(CDBReader)
+      self.assertGetMany(CDBMMapReader)
+      return
+
+    def assertRange(self, reader, path, keys):
+      db = reader(path)
+      self.assertEqual([ k for (k,_) in db.iterrange() ], keys)
+      self.assertEqual([ k for (k,_) in db.iterrange('key5', 'key6') ],
+                       [ k for k in keys if 'key5' <= k and k < 'key6' ])
+      self.assertEqual([ k for (k,_) in db.iterrange('key55x') ],
+                       [ k for k in keys if 'key55x' <= k ])
+      self.assertEqual([ k for (k,_) in db.iterprefix('key99') ],
+                       [ k for k in keys if k.startswith('key99') ])
+      self.assertEqual(list(db.iterprefix('nokey')), [])
+      return
+
+    def test_getall(self):
+      path = os.path.join(dirname, 'dup.cdb')
+      maker = CDBMaker(path, path+'.tmp')
+      maker.addmany([('a','1'), ('b','2'), ('a','3'), ('a','2')])
+      maker.finish()
+      for reader in (CDBReader, CDBMMapReader):
+        db = reader(path)
+        self.assertEqual(db.getall('a'), ['1','3','2'])
+        self.assertEqual(db.getall('b'), ['2'])
+        self.assertEqual(db.getall('c'), [])
+      return
+
+    def test_kmerge(self):
+      streams = [ iter([('a','1'), ('c','1'), ('d','1')]),
+                  iter([]),
+                  iter([('b','2'), ('c','2'), ('c','3')]),
+                  iter([('a','3'), ('c','1')]) ]
+      self.assertEqual(list(cdbmerge(streams)),
+                       [('a',['1','3']), ('b',['2']), ('c',['1','1','2','3']), ('d',['1'])])
+      streams = [ iter([('a','1'), ('b','1')]), iter([('a','1')]) ]
+      self.assertEqual(list(kmerge(streams)),
+                       [(('a','1'),0), (('a','1'),1), (('b','1'),0)])
+      return
+
+    def test_tcdbtrie(self):
+      path = os.path.join(dirname, 'test.tcdb')
+      maker = TCDBMaker(path, path+'.tmp')
+      maker.txt2tcdb([ '+1,1:a->', '++1,2:b->ab', '+++1,3:c->abc', '++1,2:c->ac',
+                       '+1,1:b->b', '++1,2:a->ba', '+1,1:c->' ])
+      maker.finish()
+      tcdb = TCDBReader(path)
+      for _ in xrange(2):               # build, then load from the cache.
+        trie = TCDBTrie(path)
+        for key in [('a',), ('a','b'), ('a','b','c'), ('a','c'),
+                    ('b',), ('b','a'), ('c',)]:
+          self.assertEqual(trie.lookup(key), tcdb.lookup(key))
+        for key in [('d',), ('a','a'), ('c','a'), ('a','b','c','d')]:
+          self.assertRaises(KeyError, trie.lookup, key)
+      self.assertTrue(os.path.exists(path+'.trie'))
+      # a rebuilt tcdb of the same size invalidates the cache.
+      maker = TCDBMaker(path, path+'.tmp')
+      maker.txt2tcdb([ '+1,1:a->', '++1,2:b->ba', '+++1,3:c->abc', '++1,2:c->ac',
+                       '+1,1:b->b', '++1,2:a->ab', '+1,1:c->' ])
+      maker.finish()
+      st = os.stat(path)
+      os.utime(path, (st.st_atime, st.st_mtime+10))
+      trie = TCDBTrie(path)
+      self.assertEqual(trie.lookup(('a','b')), TCDBReader(path).lookup(('a','b')))
+      self.assertEqual(trie.lookup(('a','b'))[-1], 'ba')
+      return
+
+    def test_largefile(self):
+      path = os.path.join(dirname, 'large.cdb')
+      maker = CDBMaker(path, path+'.tmp', keyindex=True, large=True)
+      maker.addmany(reversed(self.data))
+      maker.finish()
+      fp = file(path, 'rb')
+      self.assertEqual(unpack('<I', fp.read(4))[0], LARGEFILE_MARK)
+      fp.close()
+      for reader in (CDBReader, CDBMMapReader):
+        db = reader(path)
+        self.assertEqual(db['key5'], 'value25')
+        self.assertEqual(db.get_many(['key7', 'nokey']), ['value49', None])
+        self.assertEqual(db.getall('key7'), ['value49'])
+        self.assertEqual(db.getall('nokey'), [])
+        self.assertEqual([ k for (k,_) in db.iterprefix('key99') ],
+                         ['key99'] + [ 'key99%d' % i for i in xrange(10) ])
+        self.assertEqual(list(db.iteritems()), list(reversed(self.data)))
+      return
+
+    def test_keyindex(self):
+      keys = sorted( k for (k,_) in self.data )
+      # no key index (sorted records).
+      path = os.path.join(dirname, 'sorted0.cdb')
+      maker = CDBMaker(path, path+'.tmp')
+      for k in keys:
+        maker.add(k, k)
+      maker.finish()
+      # sampled key index (sorted records).
+      path1 = os.path.join(dirname, 'sorted1.cdb')
+      maker = CDBMaker(path1, path1+'.tmp', keyindex=True)
+      for k in keys:
+        maker.add(k, k)
+      maker.finish()
+      # full key index (unsorted records).
+      path2 = os.path.join(dirname, 'unsorted.cdb')
+      maker = CDBMaker(path2, path2+'.tmp', keyindex=True)
+      for (k,v) in self.data:
+        maker.add(k, v)
+      maker.finish()
+      for reader in (CDBReader, CDBMMapReader):
+        self.assertRange(reader, path, keys)
+        self.assertRange(reader, path1, keys)
+        self.assertRange(reader, path2, keys)
+        # without the key index, the records are found in the hash tables.
+        db = reader(path)
+        self.assertEqual([ db._key(pos) for pos in db._recordpositions() ], keys)
+        self.assertEqual([ k for (k,_) in db.iterrange('key55x', 'key57') ],
+                         [ k for k in keys if 'key55x' <= k and k < 'key57' ])
+        db = reader(path2)
+        self.assertEqual(db['key123'], 'value15129')
+        self.assertEqual(list(db.iteritems()), self.data)
+      return
+
+  suite = unittest.TestSuite()
+  suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(TestCDB))
+  return not unittest.TextTestRunner(verbosity=2).run(suite).wasSuccessful()
+
+
 # main
 def main(argv):
-  import getopt, fileinput
+  import getopt, fileinput, time
   def usage():
     print 'usage: %s {cmake,cget,cdump,cmerge} [options] cdbname [args ...]' % argv[0]
     print 'usage: %s {tmake,tget,tdump,tmerge} [options] tcdbname [args ...]' % argv[0]
+    print 'usage: %s test' % argv[0]
     return 100
   args = argv[1:]
   if not args: return usage()
   cmd = args.pop(0)
+  if cmd == 'test': return test(argv)
   try:
     (opts, args) = getopt.getopt(args, 'kv2')
   except getopt.GetoptError:
@@ -434,11 +1192,16 @@ def main(argv):
       print f(k,v)
     print
   elif cmd == 'cmerge':
+    t0 = time.time()
     dbs = [ cdbdump(fname) for fname in args ]
     m = CDBMaker(dbname, dbname+'.tmp')
-    for (k,vs) in tcdbmerge(dbs):
+    n = 0
+    for (k,vs) in cdbmerge(dbs):
       m.add(k, ' '.join(vs))
+      n += len(vs)
     m.finish()
+    t = max(time.time() - t0, 0.001)
+    print >>sys.stderr, '%s: records=%d, time=%.1fs(%.1frecords/s)' % (dbname, n, t, n/t)
   # tcdb
   elif cmd == 'tmake':
     TCDBMaker(dbname, dbname+'.tmp').txt2tcdb(fileinput.input(args)).finish()
@@ -454,11 +1217,16 @@ def main(argv):
       print f(k,v)
     print
   elif cmd == 'tmerge':
+    t0 = time.time()
     dbs = [ tcdbdump(fname) for fname in args ]
     m = TCDBMaker(dbname, dbname+'.tmp')
+    n = 0
     for (k,vs) in tcdbmerge(dbs):
       m.put(len(k), k[-1], ' '.join(vs))
+      n += len(vs)
     m.finish()
+    t = max(time.time() - t0, 0.001)
+    print >>sys.stderr, '%s: records=%d, time=%.1fs(%.1frecords/s)' % (dbname, n, t, n/t)
     
   else:
     return usage()
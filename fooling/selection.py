@@ -8,8 +8,9 @@ from struct import pack, unpack
 from array import array
 from utils import zen2han, rsplit, encodew, encodey
 from utils import splitchars, rdatefeats, lowerbound
-from utils import intersect, merge, union, decode_array
-from utils import idx_sent, idx_sents, idx_info, idx_docid2info, idx_docids
+from utils import intersect, merge, union, decode_array, posting_length
+from utils import idx_sent, idx_sents, idx_itersents
+from utils import idx_info, idx_docid2info, idx_docids
 
 __all__ = [
   'Predicate',
@@ -115,22 +116,30 @@ class KeywordPredicate(Predicate):
     return
 
   def narrow_docids(self, idx):
-    m0 = [ decode_array(idx[w]) for w in self.r0 if idx.has_key(w) ]
-    if self.r0 and not m0:
+    # Fetch all the terms at once: vs = r0 + r1 + r2.
+    vs = idx.get_many(self.r0 + self.r1 + self.r2)
+    v0 = [ v for v in vs[:len(self.r0)] if v is not None ]
+    v1 = vs[len(self.r0):len(self.r0)+len(self.r1)]
+    v2 = [ v for v in vs[len(self.r0)+len(self.r1):] if v is not None ]
+    if self.r0 and not v0:
       return []
-    m2 = [ decode_array(idx[w]) for w in self.r2 if idx.has_key(w) ]
-    if self.r2 and not m2:
+    if self.r2 and not v2:
       return []
     if self.r1:
-      try:
-        refs = intersect( decode_array(idx[w]) for w in self.r1 )
-      except KeyError:
+      if None in v1:
         return []
-      refs = union(refs, [ m for m in (m0,m2) if m ])
+      # The shortest one is decoded first. Long postings are stored
+      # in blocks and only the blocks around its pairs are decoded.
+      v1.sort(key=posting_length)
+      refs = decode_array(v1[0])
+      if 1 < len(v1):
+        refs = intersect([refs] + [ decode_array(v, refs) for v in v1[1:] ])
+      refs = union(refs, [ [ decode_array(v, refs) for v in m ] for m in (v0,v2) if m ])
     elif not self.r2:
-      refs = merge(m0)
+      refs = merge([ decode_array(v) for v in v0 ])
     else:
-      refs = union(merge(m0), [m2])
+      refs = merge([ decode_array(v) for v in v0 ])
+      refs = union(refs, [[ decode_array(v, refs) for v in v2 ]])
     # Now: refs = [ docid1,sentid1, docid2,sentid2, ... ]
     locs = [ (refs[i], refs[i+1]) for i in xrange(0, len(refs), 2) ]
     return locs
@@ -163,7 +172,7 @@ class FeatPredicate(Predicate):
     return True
   
   def narrow_docids(self, idx):
-    m0 = [ decode_array(idx[feat]) for feat in self.feats if idx.has_key(feat) ]
+    m0 = [ decode_array(v) for v in idx.get_many(self.feats) if v is not None ]
     if not m0:
       return []
     refs = merge(m0)
@@ -444,7 +453,10 @@ class Selection(object):
               docs[docid] = [(sentids, pred.checkpat)]
 
       # docs: the candidate documents in the current index file.
-      docs2 = docs.items()
+      # (excluding the deleted ones)
+      deleted = self._indexdb.get_deleted(idx.name)
+      docs2 = [ (docid,contexts) for (docid,contexts) in docs.iteritems()
+                if docid not in deleted ]
       docs2.sort(reverse=True)
       found = set()
       for (docid,contexts) in docs2:
@@ -491,11 +503,7 @@ class Selection(object):
         for (sentids,pat) in contexts:
           # make the list in ascending order.
           sentids.reverse()
-          for sentid in sentids:
-            try:
-              sent = idx_sent(idx, docid, sentid)
-            except KeyError:
-              continue
+          for (sentid,sent) in idx_itersents(idx, docid, sentids):
             if not pat or pat.search(sent):
               filtered.append(sentid)
               break
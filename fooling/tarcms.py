@@ -6,6 +6,7 @@ from indexdb import IndexDB
 from corpus import GzipTarDBCorpus
 from tardb import FixedDB
 from indexer import Indexer
+from merger import Merger
 from selection import Selection
 from tardb import ezip
 
@@ -52,9 +53,12 @@ class TarCMS(object):
   class TarCMSError(Exception): pass
   class ArticleNotFound(TarCMSError): pass
 
-  def __init__(self, basedir, doctype, encoding='utf-8', indexstyle=None, threshold=100, verbose=False):
+  def __init__(self, basedir, doctype, encoding='utf-8', indexstyle=None, threshold=100,
+               merge_policy=None, verbose=False):
     self.basedir = basedir
     self.threshold = threshold
+    # if given, the index files are merged by this policy at each flush.
+    self.merge_policy = merge_policy
     self.verbose = verbose
     self._corpus = self.GzipTarDBCorpusWithLabel(
       os.path.join(basedir, 'src'), doctype, encoding, indexstyle=indexstyle)
@@ -118,6 +122,9 @@ class TarCMS(object):
     for tid in self._loctoindex:
       indexer.index_loc(tid)
     indexer.finish()
+    if self.merge_policy and self._loctoindex:
+      merger = Merger(self._indexdb, verbose=self.verbose, policy=self.merge_policy)
+      merger.run(cleanup=True)
     self._loctoindex.clear()
     return
 
@@ -265,8 +272,9 @@ def test(argv):
   import unittest
   import shutil, tarfile, gzip, random, struct
   from document import EMailDocument
-  from selection import KeywordPredicate
+  from selection import Selection, KeywordPredicate
   from pycdb import CDBReader
+  from merger import TieredMergePolicy
   CLEANUP = True
   MAX_DATA_SIZE = 1000
   MAX_ARTICLES = 100
@@ -475,6 +483,43 @@ def test(argv):
       self.cms.validate()
       return
 
+    def testRange(self):
+      self.cms.open(mode='w')
+      for i in xrange(5):
+        self.cms.create_article('text%d common' % i)
+      self.cms.flush()
+      def search(start_loc=None, end_loc=None):
+        sel = Selection(self.cms._indexdb, [KeywordPredicate('common')],
+                        start_loc=start_loc, end_loc=end_loc)
+        return [ sel.get_snippet(x)[0] for x in sel ]
+      self.assertEqual(search(start_loc='00000003'),
+                       ['00000003', '00000002', '00000001', '00000000'])
+      self.assertEqual(search(end_loc='00000001'),
+                       ['00000004', '00000003', '00000002'])
+      self.assertEqual(search(start_loc='00000003', end_loc='00000001'),
+                       ['00000003', '00000002'])
+      self.cms.close()
+      self.cms.validate()
+      return
+
+    def testMerge(self):
+      # each flush creates a new index file; the tiered policy
+      # keeps one index file per tier (7 = 4+2+1 documents).
+      self.cms.threshold = 1
+      self.cms.merge_policy = TieredMergePolicy(0, 0, factor=2)
+      self.cms.open(mode='w')
+      for i in xrange(7):
+        self.cms.create_article('text%d' % i)
+      self.assertEqual(self.cms._indexdb.idxs,
+                       ['idx00002.cdb', 'idx00001.cdb', 'idx00000.cdb'])
+      for i in xrange(7):
+        self.assertEqual([ title for (loc,mtime,title,snippet) in
+                           self.cms.find_snapshots([KeywordPredicate('text%d' % i)]) ],
+                         [ u'text%d' % i ])
+      self.cms.close()
+      self.cms.validate()
+      return
+
     def testRandom(self):
       def randstr():
         return ''.join( chr(random.randrange(96)+32) for _ in
@@ -3,10 +3,13 @@
 
 import sys, re
 from array import array
+from zlib import compress, decompress
+from collections import OrderedDict
 from struct import pack, unpack
 
 PROP_WORD  = 0x10
 PROP_SENT  = '\x00'
+PROP_SENTS = '\x01'
 PROP_YOMI  = '\x20'
 PROP_EMAIL_MSGID = '\x80'
 PROP_EMAIL_REPLY = '\x81'
@@ -82,15 +85,17 @@ del i,c
 
 # split characters into roman words or CJK letters
 def splitchars(s):
-  s = s.strip().lower()
-  for m in TOKEN_PAT.finditer(s):
-    c = m.group(0)
-    try:
-      t = CHARTYPE[ord(c[0])]
-    except IndexError:
-      t = 0
-    yield (c,t)
-  return
+  return zip(*chartypes(s))
+
+# returns a list of roman words or CJK letters and a list of their chartypes.
+def chartypes(s):
+  cs = TOKEN_PAT.findall(s.strip().lower())
+  try:
+    ts = [ CHARTYPE[ord(c[0])] for c in cs ]
+  except IndexError:
+    # a character outside the BMP.
+    ts = [ CHARTYPE[ord(c[0])] if ord(c[0]) < 65536 else 0 for c in cs ]
+  return (cs, ts)
 
 # utilities for tokens
 def dispw(r):
@@ -108,62 +113,70 @@ def encodey(w):
 ##  Sorry, this is awful...
 ##
 def isplit(s):
-  # (t3,t2,t1): chartype at s[i-3], s[i-2] and s[i-1].
-  (t3, t2, t1) = (0, 0, 0)
-  # (c2,c1): character at s[i-2] and s[i-1].
-  (c2, c1) = ('', '')
-  # sab: separation between s[i-a] and s[i-b]
-  (s32, s21, s10) = (0, 0, 1)
+  (cs, ts) = chartypes(s)
+  return _isplit(cs, ts)
 
-  i = 0
-  for (c0,t0) in splitchars(s):
-    # (c0,t0): char and chartype at s[i].
-    #print "-,%d -[%s]- %s,%d -[%s]- %s,%d -[%s]- %s,%d" % \
-    #      (t3,s32,c2,t2,s21,c1,t1,s10,c0,t0)
-    if t0 == 0:
-      # s[i-2]   s[i-1] | s[i-0]
-      s10 = 1
+# Returns the encoded terms of isplit(s), i.e. map(encodew, isplit(s)).
+# Each character is encoded only once.
+WORD_PREFIX = [ chr(b | PROP_WORD) for b in xrange(4) ]
+def isplit_encoded(s, encoding='utf-8'):
+  (cs, ts) = chartypes(s)
+  cs = [ c.encode(encoding) for c in cs ]
+  prefix = WORD_PREFIX
+  return [ prefix[b]+w for (b,w) in _isplit(cs, ts) ]
+
+# (Internal) Returns a list of (b,w) for the characters cs and their types ts.
+#   b: (separated on the left) << 1 | (separated on the right)
+def _isplit(cs0, ts0):
+  # Remove the blanks and symbols (chartype 0) first.
+  # ss[j]: separation between cs[j-1] and cs[j].
+  (cs, ts, ss) = ([], [], [])
+  (sep, tp) = (1, 0)
+  for (c,t) in zip(cs0, ts0):
+    if t == 0:
+      sep = 1
       continue
-    # (c2,t2)-s21-(c1,t1)-s10-(c0,t0)
-    if c1:
-      if (t1 != t0) or (t0 & 8) == 0:
-        s10 = 1
-      # | (c1,t1) |
-      # - (c1,t1) |
-      # | (c1,t1) -
-      # t1==10: kanji
-      if (s21 and s10) or (t1 == 10 and (s21 or s10)):
-        yield (3, c1)
-    if 2 <= i:                          # (c2,t2) is filled
-      # (,t3)-s32-(c2,t2)-s21-(c1,t1)-s10-(c0,t0)
-      k = c2+c1
-      if (t2 | t1) & 8:
-        yield (s32 << 1 | s10, k)
-      if (t2 & t1 & 8):
-        if s32 and t3 == t2:
-          yield (s10, k)
-        if s10 and t1 == t0:
-          yield (s32 << 1, k)
-        if s32 and s10 and t3 == t2 and t1 == t0:
-          yield (0, k)
-    # shift the buffer by one character.
-    (c2, c1) = (c1, c0)
-    (t3, t2, t1) = (t2, t1, t0)
-    (s32, s21, s10) = (s21, s10, 0)
-    i += 1
+    if t != tp or (t & 8) == 0:
+      sep = 1
+    cs.append(c)
+    ts.append(t)
+    ss.append(sep)
+    (sep, tp) = (0, t)
+  # the end of the sentence.
+  ss.append(1)
 
-  # last one
-  # (,t3)-s32-(c2,t2)-s21-(c1,t1)
-  # t1==10: kanji
-  if c1 and (s21 or t1 == 10):
-    yield (3, c1)
-  if 2 <= i:
-    k = c2+c1
-    if (t2 | t1) & 8:
-      yield (s32 << 1 | 1, k)
-    if (t2 & 8) and s32 and t3 == t2:
-      yield (1, k)
-  return
+  r = []
+  m = len(cs)
+  for j in xrange(m):
+    # s1-(cs[j-1],t1)-s0-(cs[j],t0)-s2
+    (t0, s0, s2) = (ts[j], ss[j], ss[j+1])
+    # | (c,t) |
+    # - (c,t) |
+    # | (c,t) -
+    # t0==10: kanji
+    if (s0 and s2) or (t0 == 10 and (s0 or s2)):
+      r.append((3, cs[j]))
+    if j == 0: continue
+    t1 = ts[j-1]
+    if not ((t1 | t0) & 8): continue
+    # bigram
+    k = cs[j-1]+cs[j]
+    s1 = ss[j-1]
+    r.append((s1 << 1 | s2, k))
+    if j+1 < m:
+      if t1 & t0 & 8:
+        left = s1 and 2 <= j and ts[j-2] == t1
+        right = s2 and ts[j+1] == t0
+        if left:
+          r.append((s2, k))
+        if right:
+          r.append((s1 << 1, k))
+        if left and right:
+          r.append((0, k))
+    elif (t1 & 8) and s1 and 2 <= j and ts[j-2] == t1:
+      # last one
+      r.append((1, k))
+  return r
 
 
 ##  rsplit: Tokenization for searching
@@ -179,7 +192,7 @@ def rsplit(s):
   (r0, r1, r2) = ([], [], [])
   
   i = 0
-  for (c0,t0) in splitchars(s):
+  for (c0,t0) in zip(*chartypes(s)):
     # (c0,t0): char and chartype at s[i].
     #print "[%s] %s,%d [%s] %s,%d [%s] %s,%d" % \
     # (s32, c2.encode('euc-jp'),t2, s21, c1.encode('euc-jp'),t1, s10, c0.encode('euc-jp'),t0)
@@ -360,11 +373,104 @@ def merge(seqs):
   return a
 
 
+##  LRUCache
+##
+##  A dict that keeps at most maxsize items that are used recently.
+##  hits and misses count the results of get().
+##
+class LRUCache(object):
+
+  def __init__(self, maxsize):
+    self.maxsize = maxsize
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._dict = OrderedDict()
+    return
+
+  def __repr__(self):
+    return '<LRUCache: %d/%d, hits=%d, misses=%d, evictions=%d>' % \
+           (len(self._dict), self.maxsize, self.hits, self.misses, self.evictions)
+
+  def __len__(self):
+    return len(self._dict)
+
+  def __contains__(self, key):
+    return key in self._dict
+
+  def get(self, key, default=None):
+    try:
+      value = self._dict.pop(key)
+    except KeyError:
+      self.misses += 1
+      return default
+    self._dict[key] = value
+    self.hits += 1
+    return value
+
+  def put(self, key, value):
+    if key in self._dict:
+      del self._dict[key]
+    elif self.maxsize <= len(self._dict):
+      self._dict.popitem(last=False)
+      self.evictions += 1
+    self._dict[key] = value
+    return
+
+  # Changes the maximum size, evicting the least recently used entries.
+  def resize(self, maxsize):
+    self.maxsize = maxsize
+    while maxsize < len(self._dict):
+      self._dict.popitem(last=False)
+      self.evictions += 1
+    return
+
+  # Returns the keys from the least recently used one.
+  def keys(self):
+    return self._dict.keys()
+
+  def pop(self, key, default=None):
+    return self._dict.pop(key, default)
+
+  def clear(self):
+    self._dict.clear()
+    return
+
+
 ##  index file operations
 ##
+# Postings: (docid,sentid) pairs stored as an int32 array.
+#   Old format: '>i' n + raw array (n < COMPRESS_THRESHOLD)
+#                        or zlib-compressed array.
+#   Versioned format: the first byte is >= 0x80 (n is never so large).
+#     ARRAY_BLOCKS + '>ii' n,nblocks + skip table + blocks:
+#     every BLOCK_SIZE pairs are compressed separately.
+#     The skip table has (docid, sentid, end offset) of each block,
+#     so that only the blocks around the given keys can be decoded.
+#   (A delta + varint codec was tried (tools/postbench.py), but
+#   decoding it in Python is several times slower than zlib.)
 COMPRESS_THRESHOLD = 4
+BLOCK_THRESHOLD = 1024
+BLOCK_SIZE = 128
+ARRAY_BLOCKS = '\x82'
+
 def encode_array(n,a):
-  from zlib import compress
+  if BLOCK_THRESHOLD <= n:
+    skips = array('i')
+    blocks = []
+    end = 0
+    for i in xrange(0, n*2, BLOCK_SIZE*2):
+      skips.extend(a[i:i+2])
+      block = a[i:i+BLOCK_SIZE*2]
+      if SWAP_ENDIAN:
+        block.byteswap()
+      bits = compress(block.tostring())
+      blocks.append(bits)
+      end += len(bits)
+      skips.append(end)
+    if SWAP_ENDIAN:
+      skips.byteswap()
+    return ARRAY_BLOCKS + pack('>ii', n, len(blocks)) + skips.tostring() + ''.join(blocks)
   if SWAP_ENDIAN:
     a.byteswap()
   if COMPRESS_THRESHOLD <= n:
@@ -373,18 +479,83 @@ def encode_array(n,a):
     bits = a.tostring()
   return pack('>i', n) + bits
 
-def decode_array(bits):
-  from zlib import decompress
-  (n,) = unpack('>i', bits[:4])
+# Returns the number of pairs without decoding.
+def posting_length(bits):
+  if bits[0] < '\x80':
+    return unpack('>i', bits[:4])[0]
+  return unpack('>i', bits[1:5])[0]
+
+# If keys (pairs in descending order) is given, a posting stored
+# in blocks is decoded only partially: the result has all the pairs
+# in the blocks that can contain any of the keys.
+def decode_array(bits, keys=None):
   a = array('i')
-  if COMPRESS_THRESHOLD <= n:
-    a.fromstring(decompress(bits[4:]))
+  if bits[0] < '\x80':
+    (n,) = unpack('>i', bits[:4])
+    if COMPRESS_THRESHOLD <= n:
+      a.fromstring(decompress(bits[4:]))
+    else:
+      a.fromstring(bits[4:])
+  elif bits[0] == ARRAY_BLOCKS:
+    (n,nblocks) = unpack('>ii', bits[1:9])
+    base = 9+nblocks*12
+    skips = array('i')
+    skips.fromstring(bits[9:base])
+    if SWAP_ENDIAN:
+      skips.byteswap()
+    if keys == None or nblocks <= len(keys)/2:
+      # there are too many keys: all the blocks are needed anyway.
+      blocks = xrange(nblocks)
+    else:
+      blocks = select_blocks(skips, keys)
+    for i in blocks:
+      start = 0
+      if i:
+        start = skips[i*3-1]
+      a.fromstring(decompress(bits[base+start:base+skips[i*3+2]]))
   else:
-    a.fromstring(bits[4:])
+    raise ValueError('unknown posting format: 0x%02x' % ord(bits[0]))
   if SWAP_ENDIAN:
     a.byteswap()
   return a
 
+# Returns the blocks that can contain the keys.
+def select_blocks(skips, keys):
+  from bisect import bisect_left
+  # the first pairs in ascending order.
+  firsts = zip(skips[0::3], skips[1::3])
+  firsts.reverse()
+  nblocks = len(firsts)
+  r = []
+  for j in xrange(0, len(keys), 2):
+    # the last block that starts with a pair >= the key.
+    p = bisect_left(firsts, (keys[j], keys[j+1]))
+    if p < nblocks:
+      i = nblocks-1-p
+      if not r or r[-1] != i:
+        r.append(i)
+  return r
+
+# Sentence block: all the sentences (utf-8) of a document
+# compressed together with their offsets.
+def encode_sents(sents):
+  a = array('i', [0])
+  for s in sents:
+    a.append(a[-1]+len(s))
+  if SWAP_ENDIAN:
+    a.byteswap()
+  return pack('>i', len(sents)) + compress(a.tostring() + ''.join(sents))
+
+def decode_sents(bits):
+  (n,) = unpack('>i', bits[:4])
+  data = decompress(bits[4:])
+  base = (n+1)*4
+  a = array('i')
+  a.fromstring(data[:base])
+  if SWAP_ENDIAN:
+    a.byteswap()
+  return [ data[base+a[i]:base+a[i+1]] for i in xrange(n) ]
+
 # date features for indexing
 def idatefeats(t):
   import time
@@ -451,17 +622,79 @@ def rdatefeats(dates):
     addrange((y1,0,0), (y2,0,0))
   return r
 
+# Returns the sentences of a document stored as a block, or None
+# if they are stored one by one. The recent blocks are cached.
+# The caches are keyed by the file (not the reader object), so that
+# they do not keep the readers open.
+_sents_cache = LRUCache(64)
+_sents_layout = LRUCache(256)
+def idx_docsents(idx, docid):
+  fileid = (idx.name, idx.fileid)
+  blocks = _sents_layout.get(fileid)
+  if blocks == None:
+    # the sentence blocks are only written with the key index.
+    blocks = (idx.haskeyindex() and
+              next(iter(idx.iterprefix(PROP_SENTS)), None) != None)
+    _sents_layout.put(fileid, blocks)
+  if not blocks: return None
+  key = (fileid, docid)
+  sents = _sents_cache.get(key)
+  if sents == None:
+    bits = idx.get(pack('>ci', PROP_SENTS, docid))
+    if bits == None: return None
+    sents = decode_sents(bits)
+    _sents_cache.put(key, sents)
+  return sents
+
 def idx_sent(idx, docid, sentid):
+  sents = idx_docsents(idx, docid)
+  if sents != None:
+    if len(sents) <= sentid: raise KeyError(sentid)
+    return unicode(sents[sentid], 'utf-8')
   return unicode(idx[pack('>cii', PROP_SENT, docid, sentid)], 'utf-8')
 
+# Yields (sentid, sent) for the given sentids that exist.
+# The sentences are fetched in batches with a single get_many() call.
+def idx_itersents(idx, docid, sentids, batch=32):
+  sents = idx_docsents(idx, docid)
+  if sents != None:
+    for sentid in sentids:
+      if sentid < len(sents):
+        yield (sentid, unicode(sents[sentid], 'utf-8'))
+    return
+  for i in xrange(0, len(sentids), batch):
+    ids = sentids[i:i+batch]
+    keys = [ pack('>cii', PROP_SENT, docid, sentid) for sentid in ids ]
+    for (sentid,s) in zip(ids, idx.get_many(keys)):
+      if s is None: continue
+      yield (sentid, unicode(s, 'utf-8'))
+  return
+
 def idx_sents(idx, docid, sentid):
+  sents = idx_docsents(idx, docid)
+  if sents != None:
+    if len(sents) <= sentid: raise KeyError(sentid)
+    for s in sents[sentid:]:
+      yield unicode(s, 'utf-8')
+    return
   startkey = pack('>cii', PROP_SENT, docid, sentid)
-  prefix = pack('>ci', PROP_SENT, docid)
-  for (k,s) in idx.iteritems(startkey):
-    if not k.startswith(prefix): break
+  endkey = pack('>ci', PROP_SENT, docid+1)
+  for (_,s) in idx.iterrange(startkey, endkey):
     yield unicode(s, 'utf-8')
   return
 
+# Iterates the (key, value) of PROP_DOCID and PROP_LOC records.
+# The scan starts from the first docid, which can be looked up
+# even in an index file without the key index.
+def idx_iterdocinfo(idx):
+  return idx.iterrange(pack('>ci', PROP_DOCID, 1), PROP_LOC)
+
+def idx_iterlocs(idx):
+  for (k,v) in idx.iterrange(pack('>ci', PROP_DOCID, 1), PROP_IDXINFO):
+    if k[0] == PROP_LOC:
+      yield (k,v)
+  return
+
 def idx_docid2info(idx, docid):
   v = idx[pack('>ci', PROP_DOCID, docid)]
   (mtime,) = unpack('>i', v[:4])
@@ -475,6 +708,10 @@ def idx_docids(idx):
 def idx_loc2docid(idx, loc):
   return unpack('>i', idx[PROP_LOC+loc])[0]
 
+# Returns all the docids of the location (a document can have subdocuments).
+def idx_loc2docids(idx, loc):
+  return [ unpack('>i', v)[0] for v in idx.getall(PROP_LOC+loc) ]
+
 def idx_info(idx):
   return unpack('>ii', idx[PROP_IDXINFO])
 
@@ -831,6 +1068,109 @@ def test(argv):
     def test_06(self):
       self.assertSeq([[4,4,2,2,1,1], [5,5,3,3]], [5,5,4,4,3,3,2,2,1,1])
 
+  # encode_array
+  class TestArray(unittest.TestCase):
+    def assertArray(self, n):
+      a = array('i')
+      for i in xrange(n):
+        a.extend((1000000-i*3, i % 7))
+      bits = encode_array(n, array('i', a))
+      self.assertEqual(decode_array(bits), a)
+      return bits
+    def test_00(self):
+      self.assertEqual(self.assertArray(1)[:4], pack('>i', 1))
+    def test_01(self):
+      self.assertEqual(self.assertArray(COMPRESS_THRESHOLD)[:4], pack('>i', COMPRESS_THRESHOLD))
+    def test_02(self):
+      self.assertEqual(self.assertArray(BLOCK_THRESHOLD-1)[:4], pack('>i', BLOCK_THRESHOLD-1))
+    def test_03(self):
+      self.assertRaises(ValueError, decode_array, '\xfe\x00\x00\x00\x00')
+    def test_04(self):
+      n = BLOCK_THRESHOLD*3+5
+      bits = self.assertArray(n)
+      self.assertEqual(bits[0], ARRAY_BLOCKS)
+      self.assertEqual(posting_length(bits), n)
+      a = decode_array(bits)
+      # only the blocks that can contain the keys.
+      keys = array('i', (a[2]+1, 0, a[2], a[3], a[-2], a[-1]))
+      b = decode_array(bits, keys)
+      self.assertEqual(b, a[:BLOCK_SIZE*2] + a[(n-5)*2:])
+      self.assertEqual(decode_array(bits, array('i')), array('i'))
+      self.assertEqual(decode_array(bits, array('i', (a[0]+1, 0))), array('i'))
+    def test_05(self):
+      a = decode_array(encode_array(BLOCK_THRESHOLD*2, array('i', xrange(BLOCK_THRESHOLD*4, 0, -1))))
+      ref0 = array('i', (4001, 4000, 901, 900, 11, 10, 3, 2))
+      for r in (ref0, ref0[2:]):
+        refs = [ r, decode_array(encode_array(BLOCK_THRESHOLD*2, array('i', a)), r) ]
+        self.assertEqual(intersect(refs), intersect([r, a]))
+
+  # encode_sents
+  class TestSents(unittest.TestCase):
+    def test_00(self):
+      self.assertEqual(decode_sents(encode_sents([])), [])
+    def test_01(self):
+      sents = ['abc', '', u'\u3042\u3044'.encode('utf-8'), 'de']
+      self.assertEqual(decode_sents(encode_sents(sents)), sents)
+    def test_02(self):
+      import os, gc, weakref, tempfile, shutil
+      from pycdb import cdbmake, mmapinit
+      dirname = tempfile.mkdtemp()
+      try:
+        sents = ['abc', 'def', 'gh']
+        # one key per sentence (no key index) and sentence blocks.
+        path0 = os.path.join(dirname, 'sent.cdb')
+        maker = cdbmake(path0, path0+'.tmp')
+        for (i,x) in enumerate(sents):
+          maker.add(pack('>cii', PROP_SENT, 1, i), x)
+        maker.finish()
+        path1 = os.path.join(dirname, 'sents.cdb')
+        maker = cdbmake(path1, path1+'.tmp', keyindex=True)
+        maker.add(pack('>ci', PROP_SENTS, 1), encode_sents(sents))
+        maker.finish()
+        for path in (path0, path1):
+          idx = mmapinit(path)
+          self.assertEqual(idx_sent(idx, 1, 1), u'def')
+          self.assertEqual(list(idx_sents(idx, 1, 1)), [u'def', u'gh'])
+          self.assertEqual(list(idx_itersents(idx, 1, [0, 2, 5])), [(0, u'abc'), (2, u'gh')])
+          self.assertEqual(idx_docsents(idx, 1) != None, path == path1)
+          # the caches do not keep the reader.
+          ref = weakref.ref(idx)
+          del idx
+          gc.collect()
+          self.assertEqual(ref(), None)
+      finally:
+        shutil.rmtree(dirname)
+
+  # LRUCache
+  class TestLRUCache(unittest.TestCase):
+    def test_00(self):
+      c = LRUCache(2)
+      c.put('a', 1)
+      c.put('b', 2)
+      self.assertEqual(c.get('a'), 1)
+      c.put('c', 3)
+      self.assertEqual(c.get('b'), None)
+      self.assertEqual(c.get('a'), 1)
+      self.assertEqual(c.get('c'), 3)
+      self.assertEqual((len(c), c.hits, c.misses), (2, 3, 1))
+    def test_01(self):
+      c = LRUCache(2)
+      c.put('a', 1)
+      c.put('b', 2)
+      c.put('a', 3)
+      c.put('c', 4)
+      self.assertEqual(('a' in c, 'b' in c), (True, False))
+      self.assertEqual(c.keys(), ['a', 'c'])
+      self.assertEqual(c.pop('a'), 3)
+      self.assertEqual((len(c), c.evictions), (1, 1))
+    def test_02(self):
+      c = LRUCache(3)
+      for k in 'abc':
+        c.put(k, k)
+      c.get('a')
+      c.resize(2)
+      self.assertEqual((c.keys(), c.evictions), (['c', 'a'], 1))
+
   suite = unittest.TestSuite()
   suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(TestZen2Han))
   suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(TestISplit))
@@ -838,6 +1178,9 @@ def test(argv):
   suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(TestIntersect))
   suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(TestUnion))
   suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(TestMerge))
+  suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(TestLRUCache))
+  suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(TestSents))
+  suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(TestArray))
   return not unittest.TextTestRunner(verbosity=2).run(suite).wasSuccessful()
 
 if __name__ == '__main__': sys.exit(test(sys.argv))
@@ -9,12 +9,21 @@ import os.path
 import pycdb
 
 # open the dictionary
+YOMI_DICT_PATH = os.path.join(os.path.dirname(__file__), 'yomidict.tcdb')
 try:
-  YOMI_DICT = pycdb.tcdbinit(os.path.join(os.path.dirname(__file__),
-                                          'yomidict.tcdb'))
+  YOMI_DICT = pycdb.tcdbinit(YOMI_DICT_PATH)
 except IOError:
   YOMI_DICT = None
 
+# load the dictionary into memory for faster lookups.
+def load_yomi_trie(cachename=None):
+  global YOMI_DICT
+  try:
+    YOMI_DICT = pycdb.tcdbtrie(YOMI_DICT_PATH, cachename)
+  except (IOError, OSError):
+    pass
+  return YOMI_DICT
+
 
 def encode_yomi(s):
   return ''.join( chr(ord(c)-0x3000) for c in s )
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+#
+#  cdbbench.py - compares the throughput of CDBMaker
+#  against the old (unbuffered) implementation.
+#
+#  usage: cdbbench.py [-n nkeys] [-r repeat] [-d tmpdir]
+#
+import sys, os, time
+from array import array
+from struct import pack
+from fooling.pycdb import CDBMaker, CDBReader
+
+
+# the old hash function.
+def cdbhash(s, n=5381L):
+  return reduce(lambda h,c: ((h*33) ^ ord(c)) & 0xffffffffL, s, n)
+
+
+##  OldCDBMaker
+##  (the maker before buffering, for comparison)
+##
+class OldCDBMaker(CDBMaker):
+
+  def add(self, k, v):
+    (k, v) = (str(k), str(v))
+    (klen, vlen) = (len(k), len(v))
+    self._fp.seek(self._pos)
+    self._fp.write(pack('<II', klen, vlen))
+    self._fp.write(k)
+    self._fp.write(v)
+    h = cdbhash(k)
+    b = self._bucket[h % 256]
+    b.append(h)
+    b.append(self._pos)
+    self._pos += 8+klen+vlen
+    self.numentries += 1
+    return self
+
+  def finish(self):
+    self._fp.seek(self._pos)
+    pos_hash = self._pos
+    for b1 in self._bucket:
+      if not b1: continue
+      blen = len(b1)
+      a = array('I', [0]*blen*2)
+      for j in xrange(0, blen, 2):
+        (h,p) = (b1[j],b1[j+1])
+        i = ((h >> 8) % blen)*2
+        while a[i+1]:
+          i = (i+2) % len(a)
+        a[i] = h
+        a[i+1] = p
+      self._fp.write(a.tostring())
+    self._fp.seek(0)
+    a = array('I')
+    for b1 in self._bucket:
+      a.append(pos_hash)
+      a.append(len(b1))
+      pos_hash += len(b1)*8
+    self._fp.write(a.tostring())
+    self._fp.close()
+    os.rename(self.fntmp, self.fn)
+    return
+
+
+# synthetic segment: keys that look like the index terms.
+def segment(n):
+  return [ ('\x10term%08d' % i, pack('>ii', i, i*7) * (1+i%4)) for i in xrange(n) ]
+
+def bench(klass, path, data, repeat):
+  (tadd, tfinish) = (1e9, 1e9)
+  for _ in xrange(repeat):
+    t0 = time.time()
+    maker = klass(path, path+'.tmp')
+    for (k,v) in data:
+      maker.add(k, v)
+    t1 = time.time()
+    maker.finish()
+    t2 = time.time()
+    tadd = min(tadd, t1-t0)
+    tfinish = min(tfinish, t2-t1)
+  return (tadd, tfinish)
+
+# main
+def main(argv):
+  import getopt
+  def usage():
+    print 'usage: %s [-n nkeys] [-r repeat] [-d tmpdir]' % argv[0]
+    return 100
+  try:
+    (opts, args) = getopt.getopt(argv[1:], 'n:r:d:')
+  except getopt.GetoptError:
+    return usage()
+  (nkeys, repeat, tmpdir) = (200000, 3, '.')
+  for (k, v) in opts:
+    if k == '-n': nkeys = int(v)
+    elif k == '-r': repeat = int(v)
+    elif k == '-d': tmpdir = v
+  data = segment(nkeys)
+  results = []
+  for (name,klass) in (('old', OldCDBMaker), ('new', CDBMaker)):
+    path = os.path.join(tmpdir, 'cdbbench.%s.cdb' % name)
+    (tadd, tfinish) = bench(klass, path, data, repeat)
+    total = tadd+tfinish
+    print '%s: add=%.3fs, finish=%.3fs, %d keys/s' % (name, tadd, tfinish, nkeys/total)
+    results.append(path)
+  # both files must have the same contents.
+  (db0, db1) = (CDBReader(results[0]), CDBReader(results[1]))
+  for (k,v) in data[::97]:
+    assert db0[k] == db1[k] == v
+  for path in results:
+    os.unlink(path)
+  return 0
+
+if __name__ == '__main__': sys.exit(main(sys.argv))
@@ -1,26 +1,17 @@
 #!/usr/bin/env python
 import sys
-from struct import pack, unpack
+from fooling.pycdb import cdbdump
+from fooling.utils import posting_length, PROP_SENTS
 
 
 ##  countgram
 ##
 def countgram(dic, cdbname):
-  fp = file(cdbname, "rb")
-  (eor,) = unpack("<L", fp.read(4))
-  fp.seek(2048)
-  pos = 2048
-  while pos < eor:
-    (klen, vlen) = unpack("<LL", fp.read(8))
-    k = fp.read(klen)
-    v = fp.read(vlen)
-    pos += 4+4+klen+vlen
-    if not k: continue
-    if k[0] not in '\x01\x02\x03\x04\x05': continue
+  for (k,v) in cdbdump(cdbname, '\x01\x02\x03\x04\x05'):
+    # skip the sentence blocks.
+    if k[0] == PROP_SENTS: continue
     if k not in dic: dic[k] = 0
-    (n,) = unpack('>l', v[:4])
-    dic[k] += n
-  fp.close()
+    dic[k] += posting_length(v)
   print >>sys.stderr, cdbname
   return
 
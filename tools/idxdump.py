@@ -1,29 +1,23 @@
 #!/usr/bin/env python
 import sys
 from struct import pack, unpack
-from zlib import decompress
-from array import array
-
-COMPRESS_THRESHOLD = 4
-SWAP_ENDIAN = (pack('=i',1) == pack('>i',1)) # True if this is big endian.
+from fooling.pycdb import cdbdump
+from fooling.utils import decode_sents, decode_array
 
 
 ##  idxdump
 ##
-def idxdump(cdbname, codec='utf-8', debug=0):
-  fp = file(cdbname, "rb")
-  (eor,) = unpack("<L", fp.read(4))
-  fp.seek(2048)
-  pos = 2048
-  while pos < eor:
-    (klen, vlen) = unpack("<LL", fp.read(8))
-    k = fp.read(klen)
-    v = fp.read(vlen)
-    pos += 4+4+klen+vlen
+def idxdump(cdbname, codec='utf-8', debug=0, types=None):
+  for (k,v) in cdbdump(cdbname, types):
     if k[0] == '\x00':
       (docid,sentid) = unpack('>xll', k)
       v = unicode(v, 'utf-8')
       print 'sent(%d,%d) -> %s' % (docid,sentid,v.encode(codec, 'ignore'))
+    elif k[0] == '\x01':
+      (docid,) = unpack('>xl', k)
+      for (sentid,v) in enumerate(decode_sents(v)):
+        v = unicode(v, 'utf-8')
+        print 'sent(%d,%d) -> %s' % (docid,sentid,v.encode(codec, 'ignore'))
     elif k[0] == '\xfd':
       if len(k) == 5:
         (docid,) = unpack('>xl', k)
@@ -53,14 +47,7 @@ def idxdump(cdbname, codec='utf-8', debug=0):
           w = repr(k)
       else:
         w = repr(k)
-      (n,) = unpack('>i', v[:4])
-      a = array('i')
-      if COMPRESS_THRESHOLD <= n:
-        a.fromstring(decompress(v[4:]))
-      else:
-        a.fromstring(v[4:])
-      if SWAP_ENDIAN:
-        a.byteswap()
+      a = decode_array(v)
       if debug:
         k0 = (sys.maxint, sys.maxint)
         for i in xrange(0, len(a), 2):
@@ -70,26 +57,28 @@ def idxdump(cdbname, codec='utf-8', debug=0):
           k0 = k1
       print 'term(0x%02x):%s -> (%d) %s' % (ord(c), w, len(a)/2,
                                             ', '.join('%d:%d' % (a[i], a[i+1]) for i in xrange(0, len(a), 2)))
-  fp.close()
   return
 
 
 def main(argv):
   import getopt
   def usage():
-    print 'usage: %s [-d] [-e encoding] [file ...]' % argv[0]
+    print 'usage: %s [-d] [-e encoding] [-t keytypes] [file ...]' % argv[0]
+    print '  keytypes: key type bytes in hex, e.g. -t 00,fd'
     return 100
   try:
-    (opts, args) = getopt.getopt(argv[1:], 'de:')
+    (opts, args) = getopt.getopt(argv[1:], 'de:t:')
   except getopt.GetoptError:
     return usage()
   debug = 0
   codec = 'utf-8'
+  types = None
   for (k, v) in opts:
     if k == '-d': debug += 1
     elif k == '-e': codec = v
+    elif k == '-t': types = ''.join( chr(int(x, 16)) for x in v.split(',') )
   for fname in args:
-    idxdump(fname, codec=codec, debug=debug)
+    idxdump(fname, codec=codec, debug=debug, types=types)
   return
 
 if __name__ == "__main__": sys.exit(main(sys.argv))
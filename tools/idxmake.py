@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 import sys
 from fooling import document, corpus
-from fooling.indexdb import IndexDB
+from fooling.indexdb import IndexDB, Manifest
 from fooling.indexer import Indexer
 
 
@@ -10,28 +10,35 @@ from fooling.indexer import Indexer
 def index(argv):
   import getopt, locale
   def usage():
-    print 'usage: %s [-v] [-F|-U|-N|-R] [-Y] [-b basedir] [-p prefix] [-c corpustype] [-t doctype] [-e encoding] [-D maxdocs] [-T maxterms] idxdir [file ...]' % argv[0]
+    print 'usage: %s [-v] [-F|-U|-N|-R] [-C] [-Y] [-b basedir] [-p prefix] [-c corpustype] [-t doctype] [-e encoding] [-D maxdocs] [-T maxterms] [-M maxmem [-S]] [-j nworkers] [-Z] idxdir [file ...]' % argv[0]
     sys.exit(2)
   try:
-    (opts, args) = getopt.getopt(argv[1:], 'vFURNYb:p:c:t:e:D:T:')
+    (opts, args) = getopt.getopt(argv[1:], 'vFURNCYSZb:p:c:t:e:D:T:M:j:')
   except getopt.GetoptError:
     usage()
   verbose = 1
   mode = 0
+  force = False
   basedir = ''
   prefix = 'idx'
   corpustype = corpus.FilesystemCorpus
   doctype = document.PlainTextDocument
   encoding = locale.getpreferredencoding()
-  maxdocs = 1000
-  maxterms = 50000
+  maxdocs = None
+  maxterms = None
+  maxmem = 0
+  spill = False
   indexstyle = 'normal'
+  nworkers = 1
+  checksum = False
+  sentblock = False
   for (k, v) in opts:
     if k == '-d': verbose += 1
-    elif k == '-F': mode = 0 # force
+    elif k == '-F': (mode, force) = (0, True) # force
     elif k == '-U': mode = 1 # update only
     elif k == '-N': mode = 2 # new document only
     elif k == '-R': mode = 3 # reset
+    elif k == '-C': checksum = True
     elif k == '-Y': indexstyle = 'yomi'
     elif k == '-b': basedir = v
     elif k == '-p': prefix = v
@@ -40,9 +47,31 @@ def index(argv):
     elif k == '-e': encoding = v
     elif k == '-D': maxdocs = int(v)
     elif k == '-T': maxterms = int(v)
+    elif k == '-M': maxmem = int(v)
+    elif k == '-S': spill = True
+    elif k == '-j': nworkers = int(v)
+    elif k == '-Z': sentblock = True
   if not args: usage()
+  # -C skips unchanged documents, which -F would index again.
+  if checksum and force and mode == 0:
+    print >>sys.stderr, '-C cannot be used with -F.'
+    usage()
   assert len(prefix) == 3
+  # with -M (megabytes), the index size is limited by the memory.
+  if maxdocs == None:
+    if maxmem:
+      maxdocs = 0
+    else:
+      maxdocs = 1000
+  if maxterms == None:
+    if maxmem:
+      maxterms = 0
+    else:
+      maxterms = 50000
   idxdir = args[0]
+  if indexstyle == 'yomi':
+    from fooling.yomi import load_yomi_trie
+    load_yomi_trie()
   cps = corpustype(basedir, doctype, encoding, indexstyle)
   cps.open()
   indexdb = IndexDB(idxdir, prefix)
@@ -54,21 +83,32 @@ def index(argv):
   if mode == 3:
     indexdb.reset()
     mode = 0
-  indexer = Indexer(indexdb, cps, maxdocs, maxterms, verbose=verbose)
+  manifest = None
+  if checksum:
+    manifest = Manifest(indexdb.get_manifest_path())
+  indexer = Indexer(indexdb, cps, maxdocs, maxterms, maxmem*1024, spill=spill,
+                    manifest=manifest, sentblock=sentblock, verbose=verbose)
   print >>sys.stderr, \
-        'Index: basedir=%r, idxdir=%r, max_docs_threshold=%d, max_terms_threshold=%d ' % \
-        (basedir, idxdir, maxdocs, maxterms)
+        'Index: basedir=%r, idxdir=%r, max_docs_threshold=%d, max_terms_threshold=%d, max_memory_threshold=%dMB ' % \
+        (basedir, idxdir, maxdocs, maxterms, maxmem)
 
   files = args[1:]
   lastmod = indexdb.index_mtime()
   if not files:
     files = sys.stdin
-  for fname in files:
-    fname = fname.strip()
-    if not cps.loc_exists(fname): continue
-    if indexdb.loc_indexed(fname):
+  files = [ fname.strip() for fname in files ]
+  files = [ fname for fname in files if cps.loc_exists(fname) ]
+  # with -C, the indexer compares the fingerprints instead of mtimes.
+  if mode == 2 or (mode == 1 and not checksum):
+    indexed = indexdb.locs_indexed(files)
+  else:
+    indexed = [ None ] * len(files)
+  locs = []
+  for (fname,r) in zip(files, indexed):
+    if r:
       if mode == 2 or ((mode == 1) and cps.loc_mtime(fname) < lastmod): continue
-    indexer.index_loc(fname)
+    locs.append(fname)
+  indexer.index_locs(locs, nworkers=nworkers)
 
   indexer.finish()
   cps.close()
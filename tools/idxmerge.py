@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 import sys
 from fooling.indexdb import IndexDB
-from fooling.merger import Merger
+from fooling.merger import Merger, LinearMergePolicy, TieredMergePolicy
 
 
 ##  merge
@@ -9,24 +9,35 @@ from fooling.merger import Merger
 def merge(argv):
   import getopt
   def usage():
-    print 'usage: %s [-v] [-p prefix] [-D maxdocs] [-T maxterms] idxdir' % argv[0]
+    print 'usage: %s [-v] [-p prefix] [-D maxdocs] [-T maxterms] [-j nworkers] [-P policy] idxdir' % argv[0]
     sys.exit(2)
   try:
-    (opts, args) = getopt.getopt(argv[1:], 'vp:D:T:')
+    (opts, args) = getopt.getopt(argv[1:], 'vp:D:T:j:P:')
   except getopt.GetoptError:
     usage()
   (verbose, prefix, max_docs_threshold, max_terms_threshold) = (1, 'idx', 2000, 50000)
+  nworkers = 1
+  policy = 'tiered'
   for (k, v) in opts:
     if k == '-v': verbose += 1
     elif k == '-p': prefix = v
     elif k == '-D': max_docs_threshold = int(v)
     elif k == '-T': max_terms_threshold = int(v)
+    elif k == '-j': nworkers = int(v)
+    elif k == '-P': policy = v
   if not args: usage()
+  if policy == 'tiered':
+    policy = TieredMergePolicy(max_docs_threshold, max_terms_threshold)
+  elif policy == 'linear':
+    policy = LinearMergePolicy(max_docs_threshold, max_terms_threshold)
+  else:
+    usage()
   assert len(prefix) == 3
   idxdir = args[0]
   indexdb = IndexDB(idxdir, prefix)
   indexdb.open()
-  Merger(indexdb, max_docs_threshold, max_terms_threshold, verbose).run()
+  Merger(indexdb, max_docs_threshold, max_terms_threshold, verbose,
+         nworkers=nworkers, policy=policy).run()
   return
 
 # main
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#
+#  postbench.py - compares the size and decoding speed of
+#  the posting codecs on the postings of existing index files.
+#
+#  usage: postbench.py [-r repeat] idxfile ...
+#
+import sys, time
+from array import array
+from struct import pack, unpack
+from zlib import compress, decompress
+from fooling.pycdb import cdbdump
+from fooling.utils import encode_array, decode_array, SWAP_ENDIAN
+
+
+# the old codec (zlib-compressed int32 array).
+COMPRESS_THRESHOLD = 4
+def old_encode_array(n, a):
+  if SWAP_ENDIAN:
+    a.byteswap()
+  if COMPRESS_THRESHOLD <= n:
+    bits = compress(a.tostring())
+  else:
+    bits = a.tostring()
+  return pack('>i', n) + bits
+
+def old_decode_array(bits):
+  (n,) = unpack('>i', bits[:4])
+  a = array('i')
+  if COMPRESS_THRESHOLD <= n:
+    a.fromstring(decompress(bits[4:]))
+  else:
+    a.fromstring(bits[4:])
+  if SWAP_ENDIAN:
+    a.byteswap()
+  return a
+
+# delta + variable-byte codec (for reference).
+# docids are stored as the differences from the previous one.
+def varint_encode_array(n, a):
+  r = bytearray()
+  prev = 0
+  for i in xrange(0, len(a), 2):
+    for x in (abs(prev-a[i]), a[i+1]):
+      while 0x80 <= x:
+        r.append(x & 0x7f | 0x80)
+        x >>= 7
+      r.append(x)
+    prev = a[i]
+  return str(r)
+
+def varint_decode_array(bits):
+  a = array('i')
+  (x, shift, prev, odd) = (0, 0, None, False)
+  for c in bytearray(bits):
+    x |= (c & 0x7f) << shift
+    if c & 0x80:
+      shift += 7
+      continue
+    if odd:
+      a.append(x)
+    elif prev == None:
+      prev = x
+      a.append(x)
+    else:
+      # docids are in descending order.
+      prev -= x
+      a.append(prev)
+    odd = not odd
+    (x, shift) = (0, 0)
+  return a
+
+
+CODECS = (
+  ('old', old_encode_array, old_decode_array),
+  ('new', encode_array, decode_array),
+  ('varint', varint_encode_array, varint_decode_array),
+  )
+CLASSES = (1, 4, 32, 64, 128, 256, 1024, sys.maxint)
+
+def bench(decode, data, repeat):
+  t = 1e9
+  for _ in xrange(repeat):
+    t0 = time.time()
+    for bits in data:
+      decode(bits)
+    t = min(t, time.time()-t0)
+  return t
+
+# main
+def main(argv):
+  import getopt
+  def usage():
+    print 'usage: %s [-r repeat] idxfile ...' % argv[0]
+    return 100
+  try:
+    (opts, args) = getopt.getopt(argv[1:], 'r:')
+  except getopt.GetoptError:
+    return usage()
+  repeat = 3
+  for (k, v) in opts:
+    if k == '-r': repeat = int(v)
+  if not args: return usage()
+  postings = []
+  for fname in args:
+    for (k,v) in cdbdump(fname):
+      if '\x10' <= k[0] and k[0] < '\xfd':
+        postings.append(decode_array(v))
+  print '%d postings, %d pairs' % (len(postings), sum( len(a) for a in postings )/2)
+  for i in xrange(len(CLASSES)-1):
+    (n0, n1) = (CLASSES[i], CLASSES[i+1])
+    arrays = [ a for a in postings if n0 <= len(a)/2 < n1 ]
+    if not arrays: continue
+    if n1 == sys.maxint:
+      print 'n=%d-: %d postings' % (n0, len(arrays))
+    else:
+      print 'n=%d-%d: %d postings' % (n0, n1-1, len(arrays))
+    for (name,encode,decode) in CODECS:
+      data = [ encode(len(a)/2, array('i', a)) for a in arrays ]
+      # every codec must return the same postings.
+      for (a,bits) in zip(arrays, data):
+        assert decode(bits) == a
+      t = bench(decode, data, repeat)
+      print '  %s: size=%d, decode=%.3fs (%.1fus/posting)' % \
+            (name, sum( len(bits) for bits in data ), t, t*1e6/len(arrays))
+  return 0
+
+if __name__ == '__main__': sys.exit(main(sys.argv))
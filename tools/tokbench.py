@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+#
+#  tokbench.py - compares the throughput of isplit/rsplit
+#  against the old (generator-based) implementation.
+#
+#  usage: tokbench.py [-e encoding] [-r repeat] file ...
+#
+import sys, time
+from fooling.utils import TOKEN_PAT, CHARTYPE, zen2han, rmsp
+from fooling.utils import isplit, isplit_encoded, rsplit, encodew
+
+
+# the old tokenizer.
+def splitchars(s):
+  s = s.strip().lower()
+  for m in TOKEN_PAT.finditer(s):
+    c = m.group(0)
+    try:
+      t = CHARTYPE[ord(c[0])]
+    except IndexError:
+      t = 0
+    yield (c,t)
+  return
+
+def old_isplit(s):
+  # (t3,t2,t1): chartype at s[i-3], s[i-2] and s[i-1].
+  (t3, t2, t1) = (0, 0, 0)
+  # (c2,c1): character at s[i-2] and s[i-1].
+  (c2, c1) = ('', '')
+  # sab: separation between s[i-a] and s[i-b]
+  (s32, s21, s10) = (0, 0, 1)
+
+  i = 0
+  for (c0,t0) in splitchars(s):
+    # (c0,t0): char and chartype at s[i].
+    #print "-,%d -[%s]- %s,%d -[%s]- %s,%d -[%s]- %s,%d" % \
+    #      (t3,s32,c2,t2,s21,c1,t1,s10,c0,t0)
+    if t0 == 0:
+      # s[i-2]   s[i-1] | s[i-0]
+      s10 = 1
+      continue
+    # (c2,t2)-s21-(c1,t1)-s10-(c0,t0)
+    if c1:
+      if (t1 != t0) or (t0 & 8) == 0:
+        s10 = 1
+      # | (c1,t1) |
+      # - (c1,t1) |
+      # | (c1,t1) -
+      # t1==10: kanji
+      if (s21 and s10) or (t1 == 10 and (s21 or s10)):
+        yield (3, c1)
+    if 2 <= i:                          # (c2,t2) is filled
+      # (,t3)-s32-(c2,t2)-s21-(c1,t1)-s10-(c0,t0)
+      k = c2+c1
+      if (t2 | t1) & 8:
+        yield (s32 << 1 | s10, k)
+      if (t2 & t1 & 8):
+        if s32 and t3 == t2:
+          yield (s10, k)
+        if s10 and t1 == t0:
+          yield (s32 << 1, k)
+        if s32 and s10 and t3 == t2 and t1 == t0:
+          yield (0, k)
+    # shift the buffer by one character.
+    (c2, c1) = (c1, c0)
+    (t3, t2, t1) = (t2, t1, t0)
+    (s32, s21, s10) = (s21, s10, 0)
+    i += 1
+
+  # last one
+  # (,t3)-s32-(c2,t2)-s21-(c1,t1)
+  # t1==10: kanji
+  if c1 and (s21 or t1 == 10):
+    yield (3, c1)
+  if 2 <= i:
+    k = c2+c1
+    if (t2 | t1) & 8:
+      yield (s32 << 1 | 1, k)
+    if (t2 & 8) and s32 and t3 == t2:
+      yield (1, k)
+  return
+
+
+def old_rsplit(s):
+  # (t2,t1): chartype at s[i-2] and s[i-1].
+  (t2, t1) = (0, 0)
+  # (c2,c1): character at s[i-2] and s[i-1].
+  (c2, c1) = ('', '')
+  # sab: separation between s[i-a] and s[i-b]
+  (s32, s21, s10) = (0, 0, 0)
+  # (head, center, tail)
+  (r0, r1, r2) = ([], [], [])
+  
+  i = 0
+  for (c0,t0) in splitchars(s):
+    # (c0,t0): char and chartype at s[i].
+    #print "[%s] %s,%d [%s] %s,%d [%s] %s,%d" % \
+    # (s32, c2.encode('euc-jp'),t2, s21, c1.encode('euc-jp'),t1, s10, c0.encode('euc-jp'),t0)
+    if t0 == 0:
+      # s[i-2]   s[i-1] | s[i-0]
+      s10 = 1
+      continue
+    # (c1,t1)-s10-(c0,t0)
+    if i and (t1 != t0) or (t0 & 8) == 0:
+      s10 = 1
+    if 2 <= i:
+      # s32-(c2,t2)-s21-(c1,t1)-s10
+      if (t2 | t1) & 8:            # (c2,t2) is filled
+        k = c2+c1
+        if i == 2 and (t2 & 8):
+          # (c2,t1) is the first one and on the boundery.
+          assert not r1
+          r0.append((2 | s10, k))
+          if not s32:
+            r0.append((s10, k))
+        else:
+          r1.append((s32 << 1 | s10, k))
+      else:
+        # both c2 and c1 is non-japanese.
+        r1.append((3, c2))
+    (c2,c1) = (c1,c0)
+    (t2,t1) = (t1,t0)
+    (s32, s21, s10) = (s21, s10, 0)
+    i += 1
+  # the stream ended -- process the remaining chars.
+  if i == 1:
+    r1.append((3, c1))
+  elif 2 <= i:
+    # s32-(c2,t2)-s21-(c1,t1)-s10
+    k = c2+c1
+    if i == 2 and ((t2 | t1) & 8):
+      # only 2 characters.
+      assert not r1
+      # | c2+c1 |
+      r0.append((3, k))
+      if not s32 and (t2 & 8):
+        # - c2+c1 |
+        r0.append((1, k))
+      if (t1 & 8) and not s10:
+        # | c2+c1 -
+        r0.append((2, k))
+      if (t2 & t1 & 8) and (not (s32 or s10)):
+        # - c2+c1 -
+        r0.append((0, k))
+    elif t1 & 8:
+      # the last one is japanese (on the boundery).
+      r2.append((s32 << 1 | 1, k))
+      if not s10:
+        r2.append((s32 << 1, k))
+    elif t2 & 8:
+      # c2 is japanese, but c1 is non-japanese.
+      r1.append((s32 << 1 | 1, k))
+    else:
+      # both are non-japanese.
+      r1.append((3, c2))
+      r1.append((3, c1))
+  if len(r0) == 1:
+    r1.extend(r0)
+    r0 = []
+  if len(r2) == 1:
+    r1.extend(r2)
+    r2 = []
+  return (r0, r1, r2)
+
+
+def bench(func, sents, repeat):
+  t = 1e9
+  for _ in xrange(repeat):
+    t0 = time.time()
+    for s in sents:
+      func(s)
+    t = min(t, time.time()-t0)
+  return t
+
+# main
+def main(argv):
+  import getopt
+  def usage():
+    print 'usage: %s [-e encoding] [-r repeat] file ...' % argv[0]
+    return 100
+  try:
+    (opts, args) = getopt.getopt(argv[1:], 'e:r:')
+  except getopt.GetoptError:
+    return usage()
+  (encoding, repeat) = ('utf-8', 3)
+  for (k, v) in opts:
+    if k == '-e': encoding = v
+    elif k == '-r': repeat = int(v)
+  if not args: return usage()
+  sents = []
+  for fname in args:
+    fp = file(fname)
+    for line in fp:
+      line = zen2han(rmsp(unicode(line, encoding, 'replace')))
+      if line:
+        sents.append(line)
+    fp.close()
+  # both must return the same tokens.
+  for s in sents:
+    assert list(old_isplit(s)) == isplit(s)
+    assert [ encodew(x) for x in old_isplit(s) ] == isplit_encoded(s)
+    assert old_rsplit(s) == rsplit(s)
+  nchars = sum( len(s) for s in sents )
+  for (name,func) in (
+    ('old isplit+encodew', lambda s: [ encodew(x) for x in old_isplit(s) ]),
+    ('new isplit_encoded', isplit_encoded),
+    ('old rsplit', old_rsplit),
+    ('new rsplit', rsplit),
+    ):
+    t = bench(func, sents, repeat)
+    print '%s: %.3fs, %d chars/s' % (name, t, nchars/t)
+  return 0
+
+if __name__ == '__main__': sys.exit(main(sys.argv))